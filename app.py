@@ -1,4 +1,5 @@
 import re
+import threading
 from datetime import datetime
 import flask
 import dash
@@ -20,33 +21,24 @@ from dash_extensions.snippets import send_data_frame
 from dash_extensions.javascript import Namespace, arrow_function
 from datetime import datetime
 import dash_table
-import matplotlib.colors as mcolors
 import dash_bootstrap_components as dbc
 import plotly.express as px
-from precomputing import add_stopwords
 from dash.dependencies import Output, Input, State
 from dateutil import relativedelta
-from wordcloud import WordCloud, STOPWORDS
-from ldacomplaints import lda_analysis
-from sklearn.manifold import TSNE
+import dataset
+import figures
+import tiles
+import tracing
 
 # region Data
 APP_PATH = str(pathlib.Path(__file__).parent.resolve())
-cols = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
-        'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
-        'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
-        'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
-        'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL', 'nbh_id', 'nbh_name']
-# df = pd.concat([pd.read_csv(os.path.join(APP_PATH, os.path.join("data", nbh)), usecols=cols)
-#                 for nbh in os.listdir(os.path.join(APP_PATH, "data")) if nbh.endswith('.csv')])
-df = pd.read_csv(os.path.join(APP_PATH, os.path.join(
-    "data", "Merged-311_Calls_2007-2020-1497400.csv")))
-df.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
+df = dataset.load()
+calls_cube = dataset.load_cube()
 # df = df[df['nbhid'].isin([76, 89, 118, 93])]
-response_range = df.groupby('nbhid')['DAYS TO CLOSE'].agg('mean').to_dict()
-nbhnames = df.groupby('nbhid')['nbh_name'].first().to_dict()
+running_totals = dataset.running_totals(calls_cube)
+nbhnames = dataset.nbh_names(df)
 nbhnames[0] = 'No Name'
-color_prop = 'DAYS TO CLOSE'
+color_prop = dataset.COLOR_PROP
 geo_colors = [
     "#8dd3c7",
     "#ffd15f",
@@ -80,28 +72,10 @@ months = ["NA",
           "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
 
 
-embed_df = pd.read_csv(
-    "data/tsne_bigram_data.csv", index_col=0
-)  # Bigram embedding dataframe, with placeholder tsne values (at perplexity=3)
-vects_df = pd.read_csv(
-    "data/bigram_vectors.csv", index_col=0
-)  # Simple averages of GLoVe 50d vectors
-bigram_df = pd.read_csv("data/bigram_counts_data.csv", index_col=0)
-
 DATA_PATH = os.path.abspath('')
 FILENAME = "data/customer_complaints_narrative_sample.csv"
 FILENAME_PRECOMPUTED = "data/precomputed.json"
 PLOTLY_LOGO = "assets/SCC-Logo.png"
-GLOBAL_DF = pd.read_csv(os.path.join(DATA_PATH, FILENAME), header=0)
-with open(os.path.join(DATA_PATH, FILENAME_PRECOMPUTED)) as precomputed_file:
-    PRECOMPUTED_LDA = json.load(precomputed_file)
-
-"""
-We are casting the whole column to datetime to make life easier in the rest of the code.
-It isn't a terribly expensive operation so for the sake of tidyness we went this way.
-"""
-GLOBAL_DF["Date received"] = pd.to_datetime(
-    GLOBAL_DF["Date received"], format="%Y-%m-%d")
 
 """
 In order to make the graphs more useful we decided to prevent some words from being included
@@ -118,7 +92,94 @@ ADDITIONAL_STOPWORDS = [
     "dog",
     "dogs"
 ]
-STOPWORDS.update(ADDITIONAL_STOPWORDS)
+
+"""
+The bigram, wordcloud and LDA sections need sklearn, wordcloud and a few
+datasets that the map (the first thing on the page) doesn't. They are loaded
+on first use by the callbacks further down, so importing the app stays fast.
+Set KC311_WARMUP=1 to load them ahead of the first use: in the gunicorn
+master when it preloads the app (see gunicorn.conf.py), so the workers
+inherit one copy, otherwise in a background thread as soon as a worker
+serves its first request.
+"""
+WARMUP = os.environ.get("KC311_WARMUP", "0") == "1"
+_LAZY = {}
+_LAZY_LOCKS = {}
+_LAZY_LOCK = threading.Lock()
+
+
+def lazy(name, load):
+    """ Returns the result of ``load()``, calling it only once per process """
+    if name not in _LAZY:
+        with _LAZY_LOCK:
+            lock = _LAZY_LOCKS.setdefault(name, threading.Lock())
+        with lock:
+            if name not in _LAZY:
+                _LAZY[name] = load()
+    return _LAZY[name]
+
+
+def get_embed_df():
+    # Bigram embedding dataframe, with placeholder tsne values (at perplexity=3)
+    return lazy("embed_df", lambda: pd.read_csv("data/tsne_bigram_data.csv", index_col=0))
+
+
+def get_vects_df():
+    # Simple averages of GLoVe 50d vectors
+    return lazy("vects_df", lambda: pd.read_csv("data/bigram_vectors.csv", index_col=0))
+
+
+def get_bigram_df():
+    return lazy("bigram_df", lambda: pd.read_csv("data/bigram_counts_data.csv", index_col=0))
+
+
+def _load_global_df():
+    global_df = pd.read_csv(os.path.join(DATA_PATH, FILENAME), header=0)
+    # We are casting the whole column to datetime to make life easier in the rest of the code.
+    # It isn't a terribly expensive operation so for the sake of tidyness we went this way.
+    global_df["Date received"] = pd.to_datetime(
+        global_df["Date received"], format="%Y-%m-%d")
+    return global_df
+
+
+def get_global_df():
+    return lazy("GLOBAL_DF", _load_global_df)
+
+
+def _load_precomputed_lda():
+    with open(os.path.join(DATA_PATH, FILENAME_PRECOMPUTED)) as precomputed_file:
+        return json.load(precomputed_file)
+
+
+def get_precomputed_lda():
+    return lazy("PRECOMPUTED_LDA", _load_precomputed_lda)
+
+
+def _load_wordcloud():
+    from wordcloud import WordCloud, STOPWORDS
+    import precomputing  # adds its own stopwords on import
+    STOPWORDS.update(ADDITIONAL_STOPWORDS)
+    return WordCloud, STOPWORDS, precomputing.add_stopwords
+
+
+def get_wordcloud():
+    """ Returns (WordCloud, STOPWORDS, add_stopwords) """
+    return lazy("wordcloud", _load_wordcloud)
+
+
+def get_tsne():
+    def load():
+        from sklearn.manifold import TSNE
+        return TSNE
+    return lazy("TSNE", load)
+
+
+def warm_up():
+    start = datetime.now()
+    for load in [get_bigram_df, get_embed_df, get_vects_df, get_global_df,
+                 get_precomputed_lda, get_wordcloud, get_tsne]:
+        load()
+    print("warmed up NLP data in %s" % (datetime.now() - start))
 
 """
 Proudly written for Plotly by Vildly in 2019. info@vild.ly
@@ -216,7 +277,7 @@ def make_local_df(selected_bank, time_values, n_selection):
     print("got time window:", str(time_values))
     print("got n_selection:", str(n_selection), str(n_float))
     # sample the dataset according to the slider
-    local_df = sample_data(GLOBAL_DF, n_float)
+    local_df = sample_data(get_global_df(), n_float)
     if time_values is not None:
         time_values = time_slider_to_date(time_values)
         local_df = local_df[
@@ -225,6 +286,7 @@ def make_local_df(selected_bank, time_values, n_selection):
         ]
     if selected_bank:
         local_df = local_df[local_df["Company"] == selected_bank]
+        add_stopwords = get_wordcloud()[2]
         add_stopwords(selected_bank)
     return local_df
 
@@ -293,6 +355,7 @@ def make_options_bank_drop(values):
 
 def populate_lda_scatter(tsne_df, df_top3words, df_dominant_topic):
     """Calculates LDA and returns figure data you can jam into a dcc.Graph()"""
+    import matplotlib.colors as mcolors
     mycolors = np.array(
         [color for name, color in mcolors.TABLEAU_COLORS.items()])
 
@@ -334,6 +397,8 @@ def plotly_wordcloud(data_frame):
     if len(complaints_text) < 1:
         return {}, {}, {}
 
+    WordCloud, STOPWORDS, _ = get_wordcloud()
+
     # join all documents in corpus
     text = " ".join(list(complaints_text))
 
@@ -438,37 +503,40 @@ def header_section():
     )
 
 
-def get_data(nbds, years_range):
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[['LATITUDE', 'LONGITUDE', 'NEIGHBORHOOD',
-                     'DAYS TO CLOSE']]  # use only relevant columns
-    dicts = df_nbh.to_dict('rows')
-    for item in dicts:
-        item["tooltip"] = "{:.1f}".format(item[color_prop])  # bind tooltip
-        item["popup"] = item["NEIGHBORHOOD"]  # bind popup
-    geojson = dlx.dicts_to_geojson(
-        dicts, lat="LATITUDE", lon="LONGITUDE")  # convert to geojson
-    geobuf = dlx.geojson_to_geobuf(geojson)  # convert to geobuf
-    return geobuf
+def get_tile_layers(bounds, zoom, nbds, years_range, hideout):
+    """ One geobuf layer per tile in view, loaded from the /tiles route, clustered there up to clusters.MAX_ZOOM """
+    query = "nbds=%s&years=%d,%d" % (",".join(str(nbd) for nbd in nbds), years_range[0], years_range[1])
+    return [dl.GeoJSON(url=app.get_relative_path("/tiles/%d/%d/%d.pbf" % tile) + "?" + query,
+                       id="tile-%d-%d-%d-%s" % (tile + (query.replace("&", "-"),)), format="geobuf",
+                       options=dict(pointToLayer=tile_ns("pointToLayer"), onEachFeature=point_ns("onEachFeature")),
+                       hideout=hideout)
+            for tile in tiles.tiles_in_bounds(bounds, zoom, dataset.tile_extent(df))]
 
 
-def get_minmax(nbds):
-    max_range = 0
-    for nbd in nbds:
-        max_range = max(max_range, response_range[int(nbd)])
-    return dict(min=0, max=max_range * 2)
+def get_minmax(nbds, years_range=None):
+    return dataset.get_minmax(calls_cube, nbds, years_range)
 
 
 with open(os.path.join(APP_PATH, os.path.join("assets", 'KCNeighborhood.json'))) as f:
     geojson_data = json.loads(f.read())
 
 
+def _positions(coords):
+    if coords and isinstance(coords[0], (int, float)):
+        yield coords
+    else:
+        for part in coords:
+            yield from _positions(part)
+
+
+# the view before the map reports its bounds: the city
+positions = np.array([position[:2] for feature in geojson_data['features']
+                      for position in _positions(feature['geometry']['coordinates'])])
+city_bounds = [[positions[:, 1].min(), positions[:, 0].min()], [positions[:, 1].max(), positions[:, 0].max()]]
+
+
 def get_outline_data(years_range):
-    df_nbh = df[(df['CREATION YEAR'] <= years_range[1])
-                & (df['CREATION YEAR'] >= years_range[0])]
-    volumes = df_nbh.groupby(['nbhid'])['CASE ID'].count().to_dict()
+    volumes = dataset.volumes(running_totals, years_range)
     outline_data = geojson_data.copy()
     for i in range(len(outline_data['features'])):
         nbhid = int(outline_data['features'][i]['properties']['nbhid'])
@@ -481,7 +549,7 @@ def get_outline_data(years_range):
         # bind popup
         outline_data['features'][i]['properties']["popup"] = geojson_data['features'][i]['properties']['nbhname']
     # geojson_data = dlx.geojson_to_geobuf(geojson_data)  # convert to geobuf
-    return outline_data, min(volumes.values()), max(volumes.values())
+    return outline_data, dataset.volume_classes(volumes)
 
 
 # Setup a few color scales.
@@ -502,21 +570,11 @@ dd_state = dcc.Dropdown(options=state_options,
 
 # endregion
 
-minmax = get_minmax(default_state)
-# Create geojson.
-ns = Namespace("dlx", "scatter")
-geojson = dl.GeoJSON(data=get_data(default_state, [2015, 2020]), id="geojson", format="geobuf",
-                     zoomToBounds=False,  # when true, zooms to bounds when data changes
-                     cluster=True,  # when true, data are clustered
-                     # how to draw clusters
-                     clusterToLayer=ns("clusterToLayer"),
-                     # when true, zooms to bounds of feature (e.g. cluster) on click
-                     zoomToBoundsOnClick=False,
-                     # how to draw points
-                     options=dict(pointToLayer=ns("pointToLayer")),
-                     superClusterOptions=dict(
-                         radius=150),  # adjust cluster size
-                     hideout=dict(colorscale=csc_map[default_csc], colorProp=color_prop, **minmax))
+minmax = get_minmax(default_state, [2015, 2020])
+# The calls in view, one layer per tile (see update_tiles), drawn by assets/tiles.js.
+tile_ns = Namespace("kc311", "tiles")
+point_ns = Namespace("kc311", "points")
+tile_layer = dl.LayerGroup(id="tiles")
 # Create a colorbar.
 colorbar = dl.Colorbar(tooltip=True,
                        colorscale=csc_map[default_csc], id="colorbar", width=20, height=150, **minmax)
@@ -538,6 +596,43 @@ app = Dash(__name__,
            prevent_initial_callbacks=False)
 server = app.server
 
+if WARMUP:
+    @server.before_first_request
+    def start_warm_up():
+        # runs in each worker after the fork, it finds everything loaded already if the master warmed up
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+@server.route("/tiles/<int:z>/<int:x>/<int:y>.pbf")
+def tile(z, x, y):
+    args = flask.request.args
+    try:
+        nbds = [int(nbd) for nbd in args["nbds"].split(",") if nbd] if "nbds" in args else None
+        years_range = [int(year) for year in args["years"].split(",")] if "years" in args else None
+    except ValueError:
+        flask.abort(400)
+    if z > tiles.MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        flask.abort(404)
+    response = flask.Response(dataset.get_tile(df, z, x, y, nbds, years_range), mimetype="application/x-protobuf",
+                              headers={"Cache-Control": "no-cache"})
+    # revalidated on every use, a tile is only sent again when an ingest changed it
+    response.add_etag()
+    return response.make_conditional(flask.request)
+
+
+# the selection cache stats and query traces name the neighborhoods people look at, off unless KC311_DEBUG=1
+DEBUG = os.environ.get("KC311_DEBUG", "0") == "1"
+
+if DEBUG:
+    @server.route("/debug/selection-cache")
+    def selection_cache():
+        return flask.jsonify(dataset.selection_cache_info())
+
+    @server.route("/debug/traces")
+    def debug_traces():
+        return flask.jsonify(tracing.recent(flask.request.args.get("op"), flask.request.args.get("slow") == "1"))
+
+
 keys = ["watercolor", "toner", "terrain"]
 url_template = "http://{{s}}.tile.stamen.com/{}/{{z}}/{{x}}/{{y}}.png"
 attribution = 'Map tiles by <a href="http://stamen.com">Stamen Design</a>, ' \
@@ -639,7 +734,7 @@ with open('assets/us-states.json') as f:
 info = html.Div(children=get_info(), id="info", className="info",
                 style={"position": "absolute", "bottom": "80px", "right": "10px", "z-index": "1000"})
 ns = Namespace("dlx", "choropleth")
-outline_data, outline_min, outline_max = get_outline_data([2015, 2020])
+outline_data, outline_classes = get_outline_data([2015, 2020])
 
 
 """
@@ -937,10 +1032,6 @@ TOP_BIGRAM_COMPS = [
                                 [
                                     dcc.Dropdown(
                                         id="bigrams-comp_1",
-                                        options=[
-                                            {"label": i, "value": i}
-                                            for i in bigram_df.company.unique()
-                                        ],
                                         value="Blue Hills",
                                     )
                                 ],
@@ -950,10 +1041,6 @@ TOP_BIGRAM_COMPS = [
                                 [
                                     dcc.Dropdown(
                                         id="bigrams-comp_2",
-                                        options=[
-                                            {"label": i, "value": i}
-                                            for i in bigram_df.company.unique()
-                                        ],
                                         value="South Indian Mound",
                                     )
                                 ],
@@ -976,7 +1063,7 @@ BODY = dbc.Container(
             # header_section(),
                   html.Div([
                       html.Div([
-                          dl.Map(children=[dl.TileLayer(id=BASE_LAYER_ID), geojson,
+                          dl.Map(id="map", children=[dl.TileLayer(id=BASE_LAYER_ID), tile_layer,
                                            # dl.GeoJSON(data=us_states,
                                            #     # url=app.get_asset_url("us-states.json"),  # url to geojson file
                                            #          options=dict(style=ns("style")),  # how to style each polygon
@@ -997,8 +1084,7 @@ BODY = dbc.Container(
                               # style applied on hover
                               hoverStyle=arrow_function(
                                   dict(weight=5, color='#666', dashArray='')),
-                              hideout=dict(colorscale=colorscale, classes=list(range(
-                                  outline_min, outline_max, (outline_max - outline_min) // 5)), style=style, colorProp="volume"),
+                              hideout=dict(colorscale=colorscale, classes=outline_classes, style=style, colorProp="volume"),
                           ), locate_control, dl.LayersControl(
                               [dl.BaseLayer(dl.TileLayer(url=esri_url.format(variant=variants[key]['variant']), attribution=variants[key]['attribution']),
                                             name=key, checked=key == "World_Terrain_Base") for key in variants]
@@ -1076,7 +1162,7 @@ app.layout = html.Div([
 default_nbd_id = 76
 
 
-@app.callback([Output("geojson", "hideout"), Output("geojson", "data"), Output("colorbar", "colorscale"),
+@app.callback([Output("colorbar", "colorscale"),
                Output("colorbar", "min"), Output("colorbar", "max"), Output(
                    "outlines", "hideout"), Output("outlines", "data"),
                Output('nbd-selected', 'children'), Output('nbd-select-list', 'children')],
@@ -1085,10 +1171,7 @@ default_nbd_id = 76
                   'outlines', 'click_feature'), Input('dd_state', 'value')],
               [State('nbd-selected', 'children')])
 def update_map(year_slider, nbd_feature, dd_nbd, nbds):
-    if nbds:
-        nbds = json.loads(nbds) if type(nbds) != type([]) else nbds
-    else:
-        nbds = [default_nbd_id]
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
     if nbd_feature:
         nbh_id = int(nbd_feature['properties']['nbhid'])
         if nbh_id not in nbds:
@@ -1098,17 +1181,14 @@ def update_map(year_slider, nbd_feature, dd_nbd, nbds):
     new_nbd = dd_nbd if type(dd_nbd) == type([]) else [dd_nbd]
     nbds = list(set(new_nbd + nbds))
     nbds = [nbd for nbd in nbds if nbd]
-    csc, data, mm = csc_map[default_csc], get_data(
-        nbds, year_slider), get_minmax(nbds)
-    outline_data, outline_min, outline_max = get_outline_data(year_slider)
-    classes = list(range(outline_min, outline_max,
-                         (outline_max - outline_min) // 5))
-    hideout = dict(colorscale=csc, colorProp=color_prop, **mm)
+    means = dataset.mean_response(running_totals, nbds, year_slider)
+    csc, mm = csc_map[default_csc], get_minmax(nbds, year_slider)
+    outline_data, classes = get_outline_data(year_slider)
     outline_hideout = dict(colorscale=colorscale,
                            classes=classes, style=style, colorProp="volume")
     # ctg =  ["{}+".format(cl, classes[i + 1]) for i, cl in enumerate(classes[:-1])] + ["{}+".format(classes[-1])]
 
-    return hideout, data, csc, mm["min"], mm["max"], outline_hideout, outline_data, json.dumps(nbds) if dd_nbd else nbds, html.Table(className="info",
+    return csc, mm["min"], mm["max"], outline_hideout, outline_data, json.dumps(nbds) if dd_nbd else nbds, html.Table(className="info",
                                                                                                                                      children=[
                                                                                                                                          html.Thead(
                                                                                                                                              html.Tr(
@@ -1120,7 +1200,7 @@ def update_map(year_slider, nbd_feature, dd_nbd, nbds):
                                                                                                                                              [
                                                                                                                                                  html.Tr(
                                                                                                                                                      children=[
-                                                                                                                                                         html.Td(" " + nbhnames[nbd]), html.Td(f"{response_range[nbd]:.2f} days")]
+                                                                                                                                                         html.Td(" " + nbhnames[nbd]), html.Td(f"{means[nbd]:.2f} days" if nbd in means else "-")]
                                                                                                                                                  )
                                                                                                                                                  for nbd in nbds])
                                                                                                                                      ],
@@ -1128,6 +1208,15 @@ def update_map(year_slider, nbd_feature, dd_nbd, nbds):
                                                                                                                                      )
 
 
+@app.callback(Output("tiles", "children"),
+              [Input("map", "bounds"), Input("map", "zoom"), Input('nbd-selected', 'children'),
+               Input('year_slider', 'value'), Input("colorbar", "min"), Input("colorbar", "max")])
+def update_tiles(bounds, zoom, nbds, year_slider, min_days, max_days):
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    hideout = dict(colorscale=csc_map[default_csc], colorProp=color_prop, min=min_days, max=max_days)
+    return get_tile_layers(bounds or city_bounds, 11 if zoom is None else zoom, nbds, year_slider, hideout)
+
+
 @app.callback(Output("info", "children"), [Input("outlines", "hover_feature")])
 def info_hover(feature):
     return get_info(feature)
@@ -1145,16 +1234,8 @@ def update_select_nbds_list(nbd):
      State('nbd-selected', 'children')])
 def update_trends_graph(years_range, months_range, nbd_feature, nbds):
     x = list(range(years_range[0], years_range[1] + 1))
-    if nbds:
-        nbds = json.loads(nbds) if type(nbds) != type([]) else nbds
-    else:
-        nbds = [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
-    y = df_nbh.groupby(['CREATION YEAR'])['CASE ID'].count().tolist()
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    y = dataset.aggregate(calls_cube, ['CREATION YEAR'], nbds, years_range, months_range).tolist()
     return {
         'data': [dict({'x': x, 'y': y, 'type': 'bar', 'name': '311 Calls Trend'})],
         'layout': {
@@ -1170,40 +1251,11 @@ def update_trends_graph(years_range, months_range, nbd_feature, nbds):
     [Input('year_slider', 'value'), Input('month_slider', 'value'), State('nbd-selected', 'children')])
 def update_departments_graph(years_range, months_range, nbds):
     years = list(range(years_range[0], years_range[1] + 1))
-    try:
-        nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    except:
-        nbds =  [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # filter chosen states
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
-    df_nbh_deps = df_nbh.groupby(['DEPARTMENT', 'CREATION YEAR'])[
-        ['CASE ID']].count()
-    df_nbh_deps.rename(columns={'CASE ID': 'count'}, inplace=True)
-    dep_counts = df_nbh_deps.groupby(level=0).apply(
-        lambda df: df.xs(df.name).to_dict()).to_dict()
-    fig = []
-    max_count = 0
-    for ind, dep in enumerate(dep_counts):
-        counts = list(dep_counts[dep]['count'].values())
-        max_count = max(max_count, max(counts))
-        fig.append(
-            go.Scatter(
-                x=years,
-                y=counts,
-                name=dep,
-                mode="markers+lines",
-                hovertemplate="<b>" + dep + ": </b> %{y}",
-                marker=dict(
-                    size=12,
-                    opacity=0.8,
-                    color=geo_colors[ind % len(geo_colors)],
-                    line=dict(width=1, color="#ffffff"),
-                ),
-            )
-        )
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    counts = dataset.aggregate(calls_cube, ['DEPARTMENT', 'CREATION YEAR'], nbds, years_range, months_range)
+    names, matrix = figures.series_matrix(counts, years)
+    fig = figures.year_lines(names, matrix, years, geo_colors)
+    max_count = int(matrix.max()) if matrix.size else 0
 
     return {
         'data': fig,
@@ -1221,40 +1273,11 @@ def update_departments_graph(years_range, months_range, nbds):
     [Input('year_slider', 'value'), Input('month_slider', 'value'), State('nbd-selected', 'children')])
 def update_requests_graph(years_range, months_range, nbds):
     years = list(range(years_range[0], years_range[1] + 1))
-    try:
-        nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    except:
-        nbds =  [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # filter chosen states
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
-    df_nbh_deps = df_nbh.groupby(['CATEGORY', 'CREATION YEAR'])[
-        ['CASE ID']].count()
-    df_nbh_deps.rename(columns={'CASE ID': 'count'}, inplace=True)
-    dep_counts = df_nbh_deps.groupby(level=0).apply(
-        lambda df: df.xs(df.name).to_dict()).to_dict()
-    fig = []
-    max_count = 0
-    for ind, dep in enumerate(dep_counts):
-        counts = list(dep_counts[dep]['count'].values())
-        max_count = max(max_count, max(counts))
-        fig.append(
-            go.Scatter(
-                x=years,
-                y=counts,
-                name=dep,
-                mode="markers+lines",
-                hovertemplate="<b>" + dep + ": </b> %{y}",
-                marker=dict(
-                    size=12,
-                    opacity=0.8,
-                    color=geo_colors[ind % len(geo_colors)],
-                    line=dict(width=1, color="#ffffff"),
-                ),
-            )
-        )
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    counts = dataset.aggregate(calls_cube, ['CATEGORY', 'CREATION YEAR'], nbds, years_range, months_range)
+    names, matrix = figures.series_matrix(counts, years)
+    fig = figures.year_lines(names, matrix, years, geo_colors)
+    max_count = int(matrix.max()) if matrix.size else 0
 
     return {
         'data': fig,
@@ -1272,18 +1295,12 @@ def update_requests_graph(years_range, months_range, nbds):
     [Input('year_slider', 'value'), Input('month_slider', 'value'), State('nbd-selected', 'children')])
 def update_types_graph(years_range, months_range, nbds):
     years = list(range(years_range[0], years_range[1] + 1))
-    try:
-        nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    except:
-        nbds =  [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick chosen states
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    cells = dataset.aggregate(calls_cube, ['CATEGORY', 'CREATION YEAR'], nbds, years_range, months_range).reset_index()
     bins = [2007, 2011, 2016, 2020]
-    types_df = df_nbh.groupby(['CATEGORY', pd.cut(df_nbh['CREATION YEAR'], bins)])[
-        ['CASE ID']].count().unstack().fillna(0).astype(int)
+    # plain labels, so unused categories don't show up as empty request types
+    types_df = cells.groupby([cells['CATEGORY'].astype(object), pd.cut(cells['CREATION YEAR'], bins)])[
+        ['count']].sum().unstack().fillna(0).astype(int)
     types_df = types_df.rename(columns=str).reset_index().set_index('CATEGORY')
     types_df['total'] = types_df.sum(axis=1)
     types_df = types_df.nlargest(10, 'total')
@@ -1333,16 +1350,12 @@ def update_types_graph(years_range, months_range, nbds):
 @app.callback(Output("nbh_radar", "figure"),
               [Input('year_slider', 'value'), State('nbd-selected', 'children')])
 def update_radar_hours(years_range, nbds):
-    try:
-        nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    except:
-        nbds =  [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh['hour'] = df_nbh['CREATION TIME'].map(
-        lambda d: datetime.strptime(d, '%I:%M %p').hour)
-    frequencies = df_nbh.groupby(['hour'])['CASE ID'].count().tolist()
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    counts = dataset.aggregate(calls_cube, ['hour'], nbds, years_range)
+    counts = counts[counts.index >= 0]
+    frequencies = np.zeros(24, dtype=int)
+    frequencies[counts.index.to_numpy()] = counts.to_numpy()
+    frequencies = frequencies.tolist()
     fig = go.Figure(data=go.Scatterpolar(
         r=frequencies,
         theta=list(map(str, range(24))),
@@ -1372,14 +1385,9 @@ def update_radar_hours(years_range, nbds):
 @app.callback(Output("download", "data"), [Input("download_btn", "n_clicks"), State('year_slider', 'value'), State('nbd-selected', 'children')])
 def download(n_clicks, years_range, nbds):
     if n_clicks:
-        try:
-            nbds = json.loads(nbds) if nbds else [default_nbd_id]
-        except:
-            nbds =  [default_nbd_id]
-        df_nbh = df[df["nbhid"].isin(nbds)]  # filter chosen states
-        nbhname = df_nbh['nbh_name'].iloc[0]
-        df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1]) & (
-            df_nbh['CREATION YEAR'] >= years_range[0])]
+        nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+        nbhname = nbhnames.get(min(nbds), "")
+        df_nbh = dataset.export_selection(df, nbds, years_range)
         return send_data_frame(df_nbh.to_csv, "".join(["kc311_", "_".join(map(str, nbds)), '_', nbhname, '_',
                                                        str(years_range[0]), '-', str(years_range[1]), ".csv"]), index=False)
 
@@ -1389,9 +1397,11 @@ def download(n_clicks, years_range, nbds):
            "figure"), [Input("bigrams-perplex-dropdown", "value")],
 )
 def populate_bigram_scatter(perplexity):
-    X_embedded = TSNE(
-        n_components=2, perplexity=perplexity).fit_transform(vects_df)
+    X_embedded = get_tsne()(
+        n_components=2, perplexity=perplexity).fit_transform(get_vects_df())
 
+    # copy, the cached frame is shared by concurrent requests
+    embed_df = get_embed_df().copy()
     embed_df["tsne_1"] = X_embedded[:, 0]
     embed_df["tsne_2"] = X_embedded[:, 1]
     fig = px.scatter(
@@ -1414,12 +1424,23 @@ def populate_bigram_scatter(perplexity):
     return fig
 
 
+@app.callback(
+    [Output("bigrams-comp_1", "options"), Output("bigrams-comp_2", "options")],
+    [Input("bigrams-comp_1", "id")],
+)
+def populate_bigram_comp_options(_):
+    """ Fills the neighborhood dropdowns once the page loads """
+    options = [{"label": i, "value": i} for i in get_bigram_df().company.unique()]
+    return options, options
+
+
 @app.callback(
     Output("bigrams-comps", "figure"),
     [Input("bigrams-comp_1", "value"), Input("bigrams-comp_2", "value")],
 )
 def comp_bigram_comparisons(comp_first, comp_second):
     comp_list = [comp_first, comp_second]
+    bigram_df = get_bigram_df()
     temp_df = bigram_df[bigram_df.company.isin(comp_list)]
     temp_df.loc[temp_df.company == comp_list[-1], "value"] = -temp_df[
         temp_df.company == comp_list[-1]
@@ -1459,6 +1480,7 @@ def populate_time_slider(value):
     needed data to the time-window-slider.
     """
     value += 0
+    GLOBAL_DF = get_global_df()
     min_date = GLOBAL_DF["Date received"].min()
     max_date = GLOBAL_DF["Date received"].max()
 
@@ -1486,7 +1508,7 @@ def populate_bank_dropdown(time_values, n_value):
     if time_values is not None:
         pass
     n_value += 1
-    bank_names, counts = get_complaint_count_by_company(GLOBAL_DF)
+    bank_names, counts = get_complaint_count_by_company(get_global_df())
     counts.append(1)
     return make_options_bank_drop(bank_names)
 
@@ -1505,7 +1527,7 @@ def update_bank_sample_plot(n_value, time_values):
         return [{}, {"display": "block"}]
     n_float = float(n_value / 100)
     bank_sample_count = 10
-    local_df = sample_data(GLOBAL_DF, n_float)
+    local_df = sample_data(get_global_df(), n_float)
     min_date, max_date = time_slider_to_date(time_values)
     values_sample, counts_sample = calculate_bank_sample_data(
         local_df, bank_sample_count, [min_date, max_date]
@@ -1540,7 +1562,7 @@ def update_bank_sample_plot(n_value, time_values):
 )
 def update_lda_table(selected_bank, time_values):
     """ Update LDA table and scatter plot based on precomputed data """
-
+    PRECOMPUTED_LDA = get_precomputed_lda()
     if selected_bank in PRECOMPUTED_LDA:
         df_dominant_topic = pd.read_json(
             PRECOMPUTED_LDA[selected_bank]["df_dominant_topic"]
@@ -5,17 +5,15 @@ import json
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import pandas as pd
-import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from dash.dependencies import Input, Output, State
 import dash_leaflet as dl
-import dash_leaflet.express as dlx
 from dash.exceptions import PreventUpdate
 from dash_extensions.javascript import Namespace
 from dash import Dash
 import geopandas as gpd
+import dataset
 
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
@@ -41,15 +39,9 @@ mapbox_access_token = "pk.eyJ1Ijoic3JpY2hha3JhZGhhciIsImEiOiJja2lqZXh6aTYwMjE4Mn
 # srichakradhar: pk.eyJ1Ijoic3JpY2hha3JhZGhhciIsImEiOiJja2lqZXh6aTYwMjE4MndvOG5iZGUzZ2hkIn0.j6cqd-ISDEhuvAyIRb0mDA
 # Load data
 APP_PATH = str(pathlib.Path(__file__).parent.resolve())
-cols = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
-        'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
-        'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
-        'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
-        'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL', 'nbh_id', 'nbh_name']
-df = pd.concat([pd.read_csv(os.path.join(APP_PATH, os.path.join("data", nbh)), usecols=cols)
-                for nbh in os.listdir(os.path.join(APP_PATH, "data")) if nbh.endswith('.csv')])
-df.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
-color_prop = 'DAYS TO CLOSE'
+df = dataset.load("neighborhoods")
+calls_cube = dataset.load_cube("neighborhoods")
+color_prop = dataset.COLOR_PROP
 
 with open(os.path.join(APP_PATH, os.path.join("data", 'KCNeighborhood.geojson'))) as f:
     kcnbh_geojson = json.loads(f.read())
@@ -141,22 +133,11 @@ def make_base_map():
 
 
 def get_data(nbhid, years_range):
-    # filter_df = df[(df['CREATION YEAR'] <= years_range[1]) &
-    #                (df['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df[df["nbhid"] == nbhid]  # pick one state
-    df_nbh = df_nbh[['LATITUDE', 'LONGITUDE', 'NEIGHBORHOOD', 'DAYS TO CLOSE']]  # use only relevant columns
-    dicts = df_nbh.to_dict('rows')
-    for item in dicts:
-        item["tooltip"] = "{:.1f}".format(item[color_prop])  # bind tooltip
-        item["popup"] = item["NEIGHBORHOOD"]  # bind popup
-    geojson = dlx.dicts_to_geojson(dicts, lat="LATITUDE", lon="LONGITUDE")  # convert to geojson
-    geobuf = dlx.geojson_to_geobuf(geojson)  # convert to geobuf
-    return geobuf
+    return dataset.get_data(df, [nbhid], None)
 
 
 def get_minmax(nbhid):
-    df_state = df[df["nbhid"] == nbhid]  # pick one neighborhood
-    return dict(min=0, max=np.log(df_state[color_prop].max()))
+    return dataset.get_log_minmax(df, nbhid)
 
 
 # Setup a few color scales.
@@ -178,12 +159,14 @@ dd_state = dcc.Dropdown(options=state_options, value=default_state, id="dd_state
 minmax = get_minmax(default_state)
 # Create geojson.
 ns = Namespace("dlx", "scatter")
+point_ns = Namespace("kc311", "points")
 geojson = dl.GeoJSON(data=get_data(default_state, [2015, 2020]), id="geojson", format="geobuf",
                      zoomToBounds=True,  # when true, zooms to bounds when data changes
                      cluster=True,  # when true, data are clustered
                      clusterToLayer=ns("clusterToLayer"),  # how to draw clusters
                      zoomToBoundsOnClick=True,  # when true, zooms to bounds of feature (e.g. cluster) on click
-                     options=dict(pointToLayer=ns("pointToLayer")),  # how to draw points
+                     options=dict(pointToLayer=ns("pointToLayer"),
+                                  onEachFeature=point_ns("onEachFeature")),  # how to draw points and their tooltips
                      superClusterOptions=dict(radius=150),  # adjust cluster size
                      hideout=dict(colorscale=csc_map[default_csc], colorProp=color_prop, **minmax))
 # Create a colorbar.
@@ -234,8 +217,7 @@ app.layout = html.Div([
     [Input('year_slider', 'value')])
 def update_trends_graph(years_range):
     x = list(range(years_range[0], years_range[1] + 1))
-    y = df[(df['CREATION YEAR'] <= years_range[1]) & (df['CREATION YEAR'] >=
-                                                      years_range[0])].groupby(['CREATION YEAR'])['CASE ID'].count().tolist()
+    y = dataset.aggregate(calls_cube, ['CREATION YEAR'], years_range=years_range).tolist()
     return {
         'data': [dict({'x': x, 'y': y, 'type': 'bar', 'name': '311 Calls Trend'})],
         'layout': {
@@ -263,13 +245,7 @@ def update_map(region_select, years_range, ds):
     # Update map based on selectedData and stored calculation
     ctx = dash.callback_context
     # return make_base_map()
-    filter_df = df[(df['CREATION YEAR'] <= years_range[1]) &
-                   (df['CREATION YEAR'] >= years_range[0])]
-    filter_df.drop(['SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
-                    'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
-                    'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
-                    'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'STREET ADDRESS',
-                    'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL'], axis=1)
+    filter_df = dataset.select(df, years_range=years_range)
 
     # make df with consolidated
     stats_df = pd.DataFrame()
@@ -0,0 +1,21 @@
+// Tooltip and popup of the 311 call points (see pbf.py), made from their
+// NEIGHBORHOOD and DAYS TO CLOSE properties, or of a cluster of calls (see
+// clusters.py) from its point_count and mean DAYS TO CLOSE.
+window.kc311 = Object.assign({}, window.kc311, {
+    points: {
+        onEachFeature: function (feature, layer) {
+            const props = feature.properties;
+            const days = props["DAYS TO CLOSE"];
+            const closed = typeof days === "number" && !isNaN(days);
+            if (props.point_count > 1) {
+                layer.bindTooltip(closed ? props.point_count + " calls, " + days.toFixed(1) +
+                    " days to close on average" : props.point_count + " open calls");
+                return;
+            }
+            layer.bindTooltip(closed ? days.toFixed(1) : "open");
+            if (props.NEIGHBORHOOD) {
+                layer.bindPopup(props.NEIGHBORHOOD);
+            }
+        }
+    }
+});
@@ -0,0 +1,25 @@
+// Markers of the map tiles served by app.py (see tiles.py and clusters.py):
+// the clusters computed on the server, sized by their number of calls, and
+// the calls themselves, both colored by their (mean) DAYS TO CLOSE.
+window.kc311 = Object.assign({}, window.kc311, {
+    tiles: {
+        pointToLayer: function (feature, latlng, context) {
+            const {min, max, colorscale, colorProp} = context.props.hideout;
+            const csc = chroma.scale(colorscale).domain([min, max]);
+            const value = feature.properties[colorProp];
+            const color = (value === null || isNaN(value)) ? "#999999" : csc(value).hex();
+            const count = feature.properties.point_count;
+            if (!(count > 1)) {
+                return L.circleMarker(latlng, {radius: 5, color: color, fillColor: color, fillOpacity: 0.8, weight: 1});
+            }
+            // abbreviated as supercluster does
+            const label = count >= 10000 ? Math.round(count / 1000) + "k" :
+                count >= 1000 ? (Math.round(count / 100) / 10) + "k" : String(count);
+            const size = 24 + 6 * Math.min(Math.floor(Math.log10(count)), 4);
+            const html = '<div style="width: 100%; height: 100%; border-radius: 50%; opacity: 0.85; ' +
+                'display: flex; align-items: center; justify-content: center; font-weight: bold; ' +
+                'background-color: ' + color + ';">' + label + '</div>';
+            return L.marker(latlng, {icon: L.divIcon({html: html, className: "", iconSize: L.point(size, size)})});
+        }
+    }
+});
@@ -0,0 +1,152 @@
+"""
+Compressed bitmap indexes over the low-cardinality columns of the calls.
+
+``build`` keeps one bitmap of rows per value of each of ``COLUMNS``, so a
+filter over several columns is an AND of ORs of bitmaps, which does not
+read the row data. The neighborhoods, years and months are not among them:
+the calls are sorted by those (schema.SORT_KEY) and dataset.py slices them
+out of the frame directly, as ranges of rows that ``from_ranges`` turns into
+the bitmap the filter is ANDed with. Only ``positions`` turns a bitmap back
+into row numbers, for frame.take.
+
+A bitmap is a pair (words, bits): the ascending numbers of the 64-row words
+that have at least one row set, and those words as uint64. Words without a
+row set are not stored, so a value spread over all the calls costs at most
+12 bytes per 64 rows.
+"""
+import numpy as np
+import pandas as pd
+
+COLUMNS = ['DEPARTMENT', 'CATEGORY', 'SOURCE', 'STATUS']
+
+WORD = 64
+# set bits of every byte value
+_POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+def empty():
+    return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64)
+
+
+def _pack(words, bits):
+    """ The bitmap of (word, bit) pairs, ``words`` ascending, repeats ORed together """
+    if not len(words):
+        return empty()
+    starts = np.flatnonzero(np.concatenate([[True], words[1:] != words[:-1]]))
+    return words[starts], np.bitwise_or.reduceat(bits, starts)
+
+
+def from_positions(positions):
+    """ The bitmap of the ascending row ``positions`` """
+    positions = np.asarray(positions, dtype=np.int64)
+    return _pack(positions // WORD, np.left_shift(np.uint64(1), (positions % WORD).astype(np.uint64)))
+
+
+def from_ranges(starts, ends):
+    """ The bitmap of the rows of the ascending [start, end) ranges """
+    keep = ends > starts
+    starts, ends = np.asarray(starts, dtype=np.int64)[keep], np.asarray(ends, dtype=np.int64)[keep]
+    first, last = starts // WORD, (ends - 1) // WORD
+    counts = last - first + 1
+    ends_at = np.cumsum(counts)
+    words = np.arange(ends_at[-1] if len(counts) else 0, dtype=np.int64) + np.repeat(first - ends_at + counts, counts)
+    ones = np.iinfo(np.uint64).max
+    bits = np.full(len(words), ones, dtype=np.uint64)
+    # the first and last word of a range may only be partly in it
+    bits[ends_at - counts] &= np.uint64(ones) << (starts % WORD).astype(np.uint64)
+    bits[ends_at - 1] &= np.uint64(ones) >> (WORD - 1 - (ends - 1) % WORD).astype(np.uint64)
+    return _pack(words, bits)
+
+
+def full(rows):
+    """ The bitmap of all of the first ``rows`` rows """
+    words = np.arange((rows + WORD - 1) // WORD, dtype=np.int64)
+    bits = np.full(len(words), np.iinfo(np.uint64).max, dtype=np.uint64)
+    if rows % WORD:
+        bits[-1] = np.uint64((1 << (rows % WORD)) - 1)
+    return words, bits
+
+
+def build_column(values):
+    """ {value: bitmap} of the rows of each value of ``values`` (missing values left out) """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    positions = np.arange(len(codes), dtype=np.int64)
+    # by value, then row: the words of each value come out ascending
+    order = np.argsort(codes, kind='mergesort')
+    codes, positions = codes[order], positions[order]
+    bounds = np.searchsorted(codes, np.arange(len(uniques) + 1))
+    bitmaps = {}
+    for code, value in enumerate(uniques):
+        start, end = bounds[code], bounds[code + 1]
+        if end > start:
+            bitmaps[value] = from_positions(positions[start:end])
+    return bitmaps
+
+
+def build(frame, columns=COLUMNS):
+    """ The bitmap index of ``frame``: its length and {column: {value: bitmap}} """
+    return {'rows': len(frame),
+            'columns': {col: build_column(frame[col]) for col in columns if col in frame.columns}}
+
+
+def and_(a, b):
+    words, in_a, in_b = np.intersect1d(a[0], b[0], assume_unique=True, return_indices=True)
+    bits = a[1][in_a] & b[1][in_b]
+    keep = bits != 0
+    return words[keep], bits[keep]
+
+
+def or_(*bitmaps):
+    if not bitmaps:
+        return empty()
+    words = np.concatenate([bitmap[0] for bitmap in bitmaps])
+    bits = np.concatenate([bitmap[1] for bitmap in bitmaps])
+    order = np.argsort(words, kind='mergesort')
+    return _pack(words[order], bits[order])
+
+
+def andnot(a, b):
+    """ The rows of ``a`` that are not in ``b`` """
+    _, in_a, in_b = np.intersect1d(a[0], b[0], assume_unique=True, return_indices=True)
+    bits = a[1].copy()
+    bits[in_a] &= ~b[1][in_b]
+    keep = bits != 0
+    return a[0][keep], bits[keep]
+
+
+def cardinality(bitmap):
+    """ Number of rows set """
+    return int(_POPCOUNT[bitmap[1].astype('<u8').view(np.uint8)].sum(dtype=np.int64))
+
+
+def positions(bitmap):
+    """ The rows set, ascending """
+    words, bits = bitmap
+    flags = np.unpackbits(bits.astype('<u8').view(np.uint8), bitorder='little').reshape(-1, WORD)
+    word_rows, offsets = np.nonzero(flags)
+    return words[word_rows] * WORD + offsets
+
+
+def any_of(index, column, values):
+    """ The rows whose ``column`` is one of ``values`` """
+    bitmaps = index['columns'][column]
+    return or_(*[bitmaps[value] for value in values if value in bitmaps])
+
+
+def match(index, filters):
+    """
+    The rows that match every one of ``filters``, {column: allowed values},
+    all rows when there are none
+    """
+    if not filters:
+        return full(index['rows'])
+    # the shortest first, the intersections only get shorter
+    allowed = sorted((any_of(index, column, values) for column, values in filters.items()),
+                     key=lambda bitmap: len(bitmap[0]))
+    selected = allowed[0]
+    for bitmap in allowed[1:]:
+        selected = and_(selected, bitmap)
+    return selected
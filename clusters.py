@@ -0,0 +1,75 @@
+"""
+Point clusters of the map tiles, computed on the server.
+
+Up to MAX_ZOOM, a tile (see tiles.py) gets at most 64 clusters instead of
+its calls: the calls of each cell of an 8 x 8 grid over the tile (64 pixels
+of the map's 512 pixel tiles) make one cluster at their centroid, with their
+number and mean DAYS TO CLOSE.
+
+``build`` precomputes a pyramid of the cells of every zoom, each level
+merged from the one below (a cell is the four of the next zoom), with the
+sums of the calls of each neighborhood and year in every cell. The
+clusters of any selection are then the sums of the cells of its
+neighborhoods and years, and the cells of a tile are one run of a level,
+sorted by their Morton key.
+"""
+import numpy as np
+import pandas as pd
+
+import tiles
+
+# deepest tile zoom served as clusters, the calls themselves below it
+MAX_ZOOM = 14
+# cells of a tile of zoom z are the tiles of zoom z + CELL_BITS
+CELL_BITS = 3
+
+SUMS = ['count', 'lat_sum', 'lon_sum', 'days_sum', 'days_count']
+
+
+def build(points):
+    """
+    {zoom: cells} of ``points``, a frame of located calls with their
+    LATITUDE, LONGITUDE, DAYS TO CLOSE, nbhid and CREATION YEAR: the sums
+    of the calls of each neighborhood and year in each cell, by key
+    """
+    lat = points['LATITUDE'].to_numpy(dtype=float)
+    lon = points['LONGITUDE'].to_numpy(dtype=float)
+    days = points['DAYS TO CLOSE'].to_numpy(dtype=float)
+    cells = pd.DataFrame({'key': tiles.morton(*tiles.tile_xy(lat, lon, MAX_ZOOM + CELL_BITS)),
+                          'nbhid': points['nbhid'].to_numpy(),
+                          'CREATION YEAR': points['CREATION YEAR'].to_numpy(),
+                          'count': np.ones(len(points), dtype=np.int64), 'lat_sum': lat, 'lon_sum': lon,
+                          'days_sum': np.nan_to_num(days), 'days_count': (~np.isnan(days)).astype(np.int64)})
+    pyramid = {}
+    for zoom in range(MAX_ZOOM, -1, -1):
+        if zoom < MAX_ZOOM:
+            # the parent of a cell, the next level merged from this one
+            cells = cells.assign(key=cells['key'].to_numpy() >> np.uint64(2))
+        cells = cells.groupby(['key', 'nbhid', 'CREATION YEAR'], sort=True)[SUMS].sum().reset_index()
+        pyramid[zoom] = cells
+    return pyramid
+
+
+def tile_clusters(pyramid, z, x, y, nbds=None, years_range=None):
+    """
+    The clusters of the calls of ``nbds`` created within ``years_range`` in
+    tile z/x/y (z up to MAX_ZOOM): LATITUDE and LONGITUDE of their
+    centroid, point_count and mean DAYS TO CLOSE (NaN when none of their
+    calls is closed)
+    """
+    cells = pyramid[z]
+    first = tiles.morton(np.array([x]), np.array([y]))[0] << np.uint64(2 * CELL_BITS)
+    start, end = np.searchsorted(cells['key'].to_numpy(), [first, first + np.uint64(4 ** CELL_BITS)])
+    cells = cells.iloc[start:end]
+    mask = np.ones(len(cells), dtype=bool)
+    if nbds is not None:
+        mask &= np.isin(cells['nbhid'].to_numpy(), [int(nbd) for nbd in nbds])
+    if years_range is not None:
+        years = cells['CREATION YEAR'].to_numpy()
+        mask &= (years >= years_range[0]) & (years <= years_range[1])
+    sums = cells[mask].groupby('key')[SUMS].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return pd.DataFrame({'LATITUDE': sums['lat_sum'] / sums['count'],
+                             'LONGITUDE': sums['lon_sum'] / sums['count'],
+                             'point_count': sums['count'],
+                             'DAYS TO CLOSE': sums['days_sum'] / sums['days_count']}).reset_index(drop=True)
@@ -14,22 +14,17 @@ from dash.dependencies import Input, Output, State
 from dash_extensions import Download
 from dash_extensions.snippets import send_data_frame
 from dash_extensions.javascript import Namespace, arrow_function
-from datetime import datetime
+import dataset
+import figures
+import tiles
 
 # region Data
 APP_PATH = str(pathlib.Path(__file__).parent.resolve())
-cols = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
-        'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
-        'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
-        'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
-        'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL', 'nbh_id', 'nbh_name']
-# df = pd.concat([pd.read_csv(os.path.join(APP_PATH, os.path.join("data", nbh)), usecols=cols)
-#                 for nbh in os.listdir(os.path.join(APP_PATH, "data")) if nbh.endswith('.csv')])
-df = pd.read_csv(os.path.join(APP_PATH, os.path.join("data", "Merged-311_Calls_2007-2020-1497400.csv")))
-df.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
-df = df[df['nbhid'].isin([76, 89, 118, 93])]
-response_range = df.groupby('nbhid')['DAYS TO CLOSE'].agg('mean').to_dict()
-color_prop = 'DAYS TO CLOSE'
+compare_nbds = [76, 89, 118, 93]
+df = dataset.index(dataset.select(dataset.load(), compare_nbds))
+calls_cube = dataset.load_cube()
+running_totals = dataset.running_totals(calls_cube)
+color_prop = dataset.COLOR_PROP
 geo_colors = [
     "#8dd3c7",
     "#ffd15f",
@@ -74,27 +69,17 @@ def header_section():
     )
 
 
-def get_data(nbds, years_range):
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[['LATITUDE', 'LONGITUDE', 'NEIGHBORHOOD',
-                     'DAYS TO CLOSE']]  # use only relevant columns
-    dicts = df_nbh.to_dict('rows')
-    for item in dicts:
-        item["tooltip"] = "{:.1f}".format(item[color_prop])  # bind tooltip
-        item["popup"] = item["NEIGHBORHOOD"]  # bind popup
-    geojson = dlx.dicts_to_geojson(
-        dicts, lat="LATITUDE", lon="LONGITUDE")  # convert to geojson
-    geobuf = dlx.geojson_to_geobuf(geojson)  # convert to geobuf
-    return geobuf
+def get_data(nbds, years_range, bounds=None, zoom=None):
+    # the calls of the tiles around the map viewport, not the whole selection
+    if bounds is not None and zoom is not None:
+        bounds = tiles.cover_bounds(bounds, zoom, dataset.tile_extent(df))
+        return dataset.get_data(df, nbds, years_range, bounds)
+    # the whole selection from the blocks of the loaded calls, stored with them (and read from the store)
+    return dataset.get_data(dataset.load(), nbds, years_range)
 
 
-def get_minmax(nbds):
-    max_range = 0
-    for nbd in nbds:
-        max_range = max(max_range, response_range[int(nbd)])
-    return dict(min=0, max=max_range * 2)
+def get_minmax(nbds, years_range=None):
+    return dataset.get_minmax(calls_cube, nbds, years_range)
 
 
 with open(os.path.join(APP_PATH, os.path.join("assets", 'KCNeighborhood.json'))) as f:
@@ -102,9 +87,7 @@ with open(os.path.join(APP_PATH, os.path.join("assets", 'KCNeighborhood.json')))
 
 
 def get_outline_data(years_range):
-    df_nbh = df[(df['CREATION YEAR'] <= years_range[1])
-                & (df['CREATION YEAR'] >= years_range[0])]
-    volumes = df_nbh.groupby(['nbhid'])['CASE ID'].count().to_dict()
+    volumes = dataset.volumes(running_totals, years_range, compare_nbds)
     outline_data = geojson_data.copy()
     for i in range(len(outline_data['features'])):
         nbhid = int(outline_data['features'][i]['properties']['nbhid'])
@@ -117,7 +100,7 @@ def get_outline_data(years_range):
         # bind popup
         outline_data['features'][i]['properties']["popup"] = geojson_data['features'][i]['properties']['nbhname']
     # geojson_data = dlx.geojson_to_geobuf(geojson_data)  # convert to geobuf
-    return outline_data, min(volumes.values()), max(volumes.values())
+    return outline_data, dataset.volume_classes(volumes)
 
 
 # Setup a few color scales.
@@ -139,9 +122,10 @@ dd_state = dcc.Dropdown(options=state_options,
 
 # endregion
 
-minmax = get_minmax(default_state)
+minmax = get_minmax(default_state, [2015, 2020])
 # Create geojson.
 ns = Namespace("dlx", "scatter")
+point_ns = Namespace("kc311", "points")
 geojson = dl.GeoJSON(data=get_data(default_state, [2015, 2020]), id="geojson", format="geobuf",
                      zoomToBounds=False,  # when true, zooms to bounds when data changes
                      cluster=True,  # when true, data are clustered
@@ -150,7 +134,8 @@ geojson = dl.GeoJSON(data=get_data(default_state, [2015, 2020]), id="geojson", f
                      # when true, zooms to bounds of feature (e.g. cluster) on click
                      zoomToBoundsOnClick=False,
                      # how to draw points
-                     options=dict(pointToLayer=ns("pointToLayer")),
+                     options=dict(pointToLayer=ns("pointToLayer"),
+                                  onEachFeature=point_ns("onEachFeature")),
                      superClusterOptions=dict(
                          radius=150),  # adjust cluster size
                      hideout=dict(colorscale=csc_map[default_csc], colorProp=color_prop, **minmax))
@@ -276,7 +261,7 @@ info = html.Div(children=get_info(), id="info", className="info",
                 style={"position": "absolute", "bottom": "80px", "right": "10px", "z-index": "1000"})
 
 ns = Namespace("dlx", "choropleth")
-outline_data, outline_min, outline_max = get_outline_data([2015, 2020])
+outline_data, outline_classes = get_outline_data([2015, 2020])
 app.layout = html.Div([
     header_section(),
     html.Div([
@@ -301,12 +286,11 @@ app.layout = html.Div([
                 # style applied on hover
                 hoverStyle=arrow_function(
                     dict(weight=5, color='#666', dashArray='')),
-                hideout=dict(colorscale=colorscale, classes=list(range(
-                    outline_min, outline_max, (outline_max - outline_min) // 5)), style=style, colorProp="volume"),
+                hideout=dict(colorscale=colorscale, classes=outline_classes, style=style, colorProp="volume"),
             ), locate_control, dl.LayersControl(
                 [dl.BaseLayer(dl.TileLayer(url=esri_url.format(variant=variants[key]['variant']), attribution=variants[key]['attribution']),
                               name=key, checked=key == "World_Terrain_Base") for key in variants]
-            ), colorbar, nbd_colorbar, info], zoom=11, center=(39.1, -94.5786)),
+            ), colorbar, nbd_colorbar, info], id="map", zoom=11, center=(39.1, -94.5786)),
             html.Div([dd_state],
                      style={"position": "relative", "bottom": "80px", "right": "10px", "z-index": "1000", "width": "300px"}),
             # html.Div(id="nbd-select-list",
@@ -359,13 +343,8 @@ default_nbd_id = 76
     State('nbd-selected', 'children')])
 def update_trends_graph(years_range, months_range, nbd_feature, nbds):
     x = list(range(years_range[0], years_range[1] + 1))
-    nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
-    y = df_nbh.groupby(['CREATION YEAR'])['CASE ID'].count().tolist()
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    y = dataset.aggregate(calls_cube, ['CREATION YEAR'], nbds, years_range, months_range).tolist()
     return {
         'data': [dict({'x': x, 'y': y, 'type': 'bar', 'name': '311 Calls Trend'})],
         'layout': {
@@ -381,37 +360,11 @@ def update_trends_graph(years_range, months_range, nbd_feature, nbds):
     [Input('year_slider', 'value'), Input('month_slider', 'value'), State('nbd-selected', 'children')])
 def update_departments_graph(years_range, months_range, nbds):
     years = list(range(years_range[0], years_range[1] + 1))
-    nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # filter chosen states
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
-    df_nbh_deps = df_nbh.groupby(['DEPARTMENT', 'CREATION YEAR'])[
-        ['CASE ID']].count()
-    df_nbh_deps.rename(columns={'CASE ID': 'count'}, inplace=True)
-    dep_counts = df_nbh_deps.groupby(level=0).apply(
-        lambda df: df.xs(df.name).to_dict()).to_dict()
-    fig = []
-    max_count = 0
-    for ind, dep in enumerate(dep_counts):
-        counts = list(dep_counts[dep]['count'].values())
-        max_count = max(max_count, max(counts))
-        fig.append(
-            go.Scatter(
-                x=years,
-                y=counts,
-                name=dep,
-                mode="markers+lines",
-                hovertemplate="<b>" + dep + ": </b> %{y}",
-                marker=dict(
-                    size=12,
-                    opacity=0.8,
-                    color=geo_colors[ind % len(geo_colors)],
-                    line=dict(width=1, color="#ffffff"),
-                ),
-            )
-        )
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    counts = dataset.aggregate(calls_cube, ['DEPARTMENT', 'CREATION YEAR'], nbds, years_range, months_range)
+    names, matrix = figures.series_matrix(counts, years)
+    fig = figures.year_lines(names, matrix, years, geo_colors)
+    max_count = int(matrix.max()) if matrix.size else 0
 
     return {
         'data': fig,
@@ -429,15 +382,12 @@ def update_departments_graph(years_range, months_range, nbds):
     [Input('year_slider', 'value'), Input('month_slider', 'value'), State('nbd-selected', 'children')])
 def update_types_graph(years_range, months_range, nbds):
     years = list(range(years_range[0], years_range[1] + 1))
-    nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick chosen states
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[(df_nbh['CREATION MONTH'] <= months_range[1])
-                    & (df_nbh['CREATION MONTH'] >= months_range[0])]
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    cells = dataset.aggregate(calls_cube, ['CATEGORY', 'CREATION YEAR'], nbds, years_range, months_range).reset_index()
     bins = [2007, 2011, 2016, 2020]
-    types_df = df_nbh.groupby(['CATEGORY', pd.cut(df_nbh['CREATION YEAR'], bins)])[
-        ['CASE ID']].count().unstack().fillna(0).astype(int)
+    # plain labels, so unused categories don't show up as empty request types
+    types_df = cells.groupby([cells['CATEGORY'].astype(object), pd.cut(cells['CREATION YEAR'], bins)])[
+        ['count']].sum().unstack().fillna(0).astype(int)
     types_df = types_df.rename(columns=str).reset_index().set_index('CATEGORY')
     types_df['total'] = types_df.sum(axis=1)
     types_df = types_df.nlargest(10, 'total')
@@ -484,27 +434,31 @@ def update_types_graph(years_range, months_range, nbds):
     return fig
 
 
-@app.callback([Output("geojson", "hideout"), Output("geojson", "data"), Output("colorbar", "colorscale"),
+@app.callback([Output("geojson", "hideout"), Output("colorbar", "colorscale"),
                Output("colorbar", "min"), Output("colorbar", "max"),
                Output("outlines", "hideout"), Output("outlines", "data"), Output('nbd-selected', 'children')],
               #    Output("outline_colorbar", "categories")],
               [Input('year_slider', 'value'), Input('outlines', 'click_feature'), State('nbd-selected', 'children')])
 def update_map(year_slider, nbd_feature, nbds):
-    nbds = list(map(int, json.loads(nbds))) if nbds else [default_nbd_id]
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
     if nbd_feature:
         nbds.append(int(nbd_feature['properties']['nbhid']))
     else:
         nbds = [default_nbd_id]
-    csc, data, mm = csc_map[default_csc], get_data(
-        nbds, year_slider), get_minmax(nbds)
-    outline_data, outline_min, outline_max = get_outline_data(year_slider)
-    classes = list(range(outline_min, outline_max,
-                         (outline_max - outline_min) // 5))
+    csc, mm = csc_map[default_csc], get_minmax(nbds, year_slider)
+    outline_data, classes = get_outline_data(year_slider)
     hideout = dict(colorscale=csc, colorProp=color_prop, **mm)
     outline_hideout = dict(colorscale=colorscale,
                            classes=classes, style=style, colorProp="volume")
     # ctg =  ["{}+".format(cl, classes[i + 1]) for i, cl in enumerate(classes[:-1])] + ["{}+".format(classes[-1])]
-    return hideout, data, csc, mm["min"], mm["max"], outline_hideout, outline_data, json.dumps(nbds)
+    return hideout, csc, mm["min"], mm["max"], outline_hideout, outline_data, json.dumps(nbds)
+
+
+@app.callback(Output("geojson", "data"),
+              [Input("map", "bounds"), Input("map", "zoom"), Input('nbd-selected', 'children'),
+               Input('year_slider', 'value')])
+def update_points(bounds, zoom, nbds, year_slider):
+    return get_data(dataset.parse_nbds(nbds, [default_nbd_id]), year_slider, bounds, zoom)
 
 
 @app.callback(Output("info", "children"), [Input("outlines", "hover_feature")])
@@ -515,13 +469,12 @@ def info_hover(feature):
 @app.callback(Output("nbh_radar", "figure"),
               [Input('year_slider', 'value'), State('nbd-selected', 'children')])
 def update_radar_hours(years_range, nbds):
-    nbds = json.loads(nbds) if nbds else [default_nbd_id]
-    df_nbh = df[df["nbhid"].isin(nbds)]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1])
-                    & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh['hour'] = df_nbh['CREATION TIME'].map(
-        lambda d: datetime.strptime(d, '%I:%M %p').hour)
-    frequencies = df_nbh.groupby(['hour'])['CASE ID'].count().tolist()
+    nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+    counts = dataset.aggregate(calls_cube, ['hour'], nbds, years_range)
+    counts = counts[counts.index >= 0]
+    frequencies = np.zeros(24, dtype=int)
+    frequencies[counts.index.to_numpy()] = counts.to_numpy()
+    frequencies = frequencies.tolist()
     fig = go.Figure(data=go.Scatterpolar(
         r=frequencies,
         theta=list(map(str, range(24))),
@@ -551,12 +504,10 @@ def update_radar_hours(years_range, nbds):
 @app.callback(Output("download", "data"), [Input("download_btn", "n_clicks"), State('year_slider', 'value'), State('nbd-selected', 'children')])
 def download(n_clicks, years_range, nbds):
     if n_clicks:
-        nbds = json.loads(nbds) if nbds else [default_nbd_id]
-        df_nbh = df[df["nbhid"].isin(nbds)]  # filter chosen states
-        nbhname = df_nbh['nbh_name'].iloc[0]
-        df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1]) & (
-            df_nbh['CREATION YEAR'] >= years_range[0])]
-        return send_data_frame(df_nbh.to_csv, "".join(["kc311_", "_".join(nbds), '_', nbhname, '_',
+        nbds = dataset.parse_nbds(nbds, [default_nbd_id])
+        nbhname = state_names.get(min(nbds), "")
+        df_nbh = dataset.export_selection(dataset.load(), nbds, years_range)
+        return send_data_frame(df_nbh.to_csv, "".join(["kc311_", "_".join(map(str, nbds)), '_', nbhname, '_',
                                                        str(years_range[0]), '-', str(years_range[1]), ".csv"]), index=False)
 
 
@@ -0,0 +1,240 @@
+"""
+Pre-aggregated 311 call counts for the chart callbacks.
+
+Every chart of the apps (trend, departments, categories, request types, hour
+radar, outline volumes) is a count over some of ``DIMENSIONS`` of the calls
+of a few neighborhoods within a year and month range. The cube holds the
+``MEASURES`` of every combination of those dimensions that occurs, so a
+callback sums a few thousand cells instead of grouping the selected calls,
+and its cost does not grow with the number of calls.
+
+A cube over all six dimensions would have about one cell per call, so it is
+kept as a few cuboids, each summed over the dimensions its charts do not
+need; ``query`` answers from the smallest cuboid that has the dimensions it
+is asked for. The cuboids are stored as snapshots (see snapshot.py) under
+data/snapshot/cube/<source>, stamped with the manifest of the snapshot the
+calls were loaded from, and rebuilt when that changes; for calls merged from
+the store, only the cells of the partitions that changed are (see
+``patch``). To build them ahead of the app start:
+
+    python cube.py               # merged dataset (or store)
+    python cube.py neighborhoods # data/*_neighborhood.csv
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import sketch
+import store
+from schema import concat
+from snapshot import SNAPSHOT_PATH, is_fresh, read_manifest, read_snapshot, write_snapshot
+
+CUBE_PATH = os.path.join(SNAPSHOT_PATH, "cube")
+# bumped when the cells of the cuboids change, the stored ones are rebuilt then
+CUBE_FORMAT = 2
+
+# days_bucket is the DAYS TO CLOSE quantile sketch bucket (see sketch.py)
+DIMENSIONS = ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'DEPARTMENT', 'CATEGORY', 'hour', 'days_bucket']
+# number of calls, sum and number of the known DAYS TO CLOSE, number of calls
+# that exceeded their estimated timeframe
+MEASURES = ['count', 'days_sum', 'days_count', 'exceeded']
+
+# {name: dimensions}, the cube summed over the dimensions that are left out
+CUBOIDS = {
+    'months': ['nbhid', 'CREATION YEAR', 'CREATION MONTH'],
+    'departments': ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'DEPARTMENT'],
+    'categories': ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'CATEGORY'],
+    'hours': ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'hour'],
+    'days': ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'DEPARTMENT', 'days_bucket'],
+}
+# the cuboids that leave out the calls without a value of their dimension
+# (the open calls have no days_bucket), only used for queries on it
+PARTIAL = {'days': 'days_bucket'}
+
+
+def facts(frame):
+    """ The dimensions and measures of every call in ``frame`` """
+    days = frame['DAYS TO CLOSE'].to_numpy(dtype=float)
+    facts = pd.DataFrame({dim: frame[dim].array for dim in DIMENSIONS if dim in frame.columns})
+    facts['days_bucket'] = sketch.buckets(days)
+    facts['count'] = np.ones(len(frame), dtype=np.int32)
+    facts['days_sum'] = np.nan_to_num(days)
+    facts['days_count'] = (~np.isnan(days)).astype(np.int32)
+    facts['exceeded'] = (frame['EXCEEDED EST TIMEFRAME'].astype(object) == 'Y').to_numpy().astype(np.int32)
+    return facts
+
+
+def build(frame):
+    """ {cuboid name: cuboid} of the calls in ``frame`` """
+    calls = facts(frame)
+    cube = {}
+    for name, dims in CUBOIDS.items():
+        cells = calls
+        if name in PARTIAL:
+            cells = calls[calls[PARTIAL[name]].notna().to_numpy()]
+        # missing values (e.g. of DEPARTMENT) are cells too, the other cuboids keep every call
+        cuboid = cells.groupby(dims, observed=True, dropna=False)[MEASURES].sum().reset_index()
+        dtypes = {'count': np.int32, 'days_count': np.int32, 'exceeded': np.int32}
+        if 'days_bucket' in dims:
+            dtypes['days_bucket'] = np.int16
+        cube[name] = cuboid.astype(dtypes)
+    return cube
+
+
+def _partition_keys(nbhids, years):
+    return np.asarray(nbhids, dtype=np.int64) * 10000 + np.asarray(years, dtype=np.int64)
+
+
+def patch(cube, frame, touched):
+    """
+    ``cube`` with the cells of the store partitions ``touched``, (year,
+    nbhid) pairs, rebuilt from their calls in ``frame``
+    """
+    touched = [nbhid * 10000 + year for year, nbhid in touched]
+    rows = np.isin(_partition_keys(frame['nbhid'].to_numpy(), frame['CREATION YEAR'].to_numpy()), touched)
+    cells = build(frame.take(np.flatnonzero(rows)))
+    patched = {}
+    for name, dims in CUBOIDS.items():
+        cuboid = cube[name]
+        kept = ~np.isin(_partition_keys(cuboid['nbhid'].to_numpy(), cuboid['CREATION YEAR'].to_numpy()), touched)
+        cuboid = concat([cuboid[kept], cells[name]]).astype(cells[name].dtypes.to_dict())
+        patched[name] = cuboid.sort_values(dims, kind='mergesort').reset_index(drop=True)
+    return patched
+
+
+def load(frame, source, sources, partitions=None):
+    """
+    The cube of ``frame``, the calls of ``source`` ("merged" or
+    "neighborhoods") loaded from ``sources``: read back from its snapshots
+    while they are fresh, built and stored otherwise. ``partitions`` are
+    the store partitions the calls were merged from, if they were (see
+    store.merge).
+    """
+    start = time.time()
+    paths = {name: os.path.join(CUBE_PATH, source, name) for name in CUBOIDS}
+    manifests = {name: read_manifest(path) for name, path in paths.items()}
+    if all(is_fresh(path, sources) and manifests[name].get("cube") == CUBE_FORMAT for name, path in paths.items()):
+        cube = {name: read_snapshot(path) for name, path in paths.items()}
+        print("loaded the %s cube (%d cells) in %.2fs"
+              % (source, sum(len(cuboid) for cuboid in cube.values()), time.time() - start))
+        return cube
+    built = [manifest.get("partitions") for manifest in manifests.values()
+             if manifest is not None and manifest.get("cube") == CUBE_FORMAT]
+    patchable = (partitions is not None and len(built) == len(CUBOIDS) and built[0] is not None
+                 and all(entries == built[0] for entries in built))
+    if patchable:
+        touched = store.changed(built[0], partitions)
+        cube = patch({name: read_snapshot(path) for name, path in paths.items()}, frame, touched)
+        action = "patched %d partitions of" % len(touched)
+    else:
+        cube = build(frame)
+        action = "built"
+    try:
+        for name, path in paths.items():
+            write_snapshot(cube[name], path, sources, extra={"cube": CUBE_FORMAT, "partitions": partitions})
+    except OSError as e:
+        print("could not store the %s cube: %s" % (source, e))
+    print("%s the %s cube (%d cells) from %d rows in %.1fs"
+          % (action, source, sum(len(cuboid) for cuboid in cube.values()), len(frame), time.time() - start))
+    return cube
+
+
+def query(cube, by, nbds=None, years_range=None, months_range=None, measures='count', filters=None):
+    """
+    ``measures`` (one name or a list) summed over the cells of the ``nbds``
+    neighborhoods within the (inclusive) year and month ranges and matching
+    ``filters`` ({dimension: allowed values}), grouped by the dimensions
+    ``by``. Combinations without calls are left out.
+    """
+    by = list(by)
+    filters = filters or {}
+    needed = set(by) | set(filters)
+    candidates = [name for name, dims in CUBOIDS.items()
+                  if needed <= set(dims) and (name not in PARTIAL or PARTIAL[name] in needed)]
+    if not candidates:
+        raise ValueError("no cuboid has the dimensions %s" % ", ".join(sorted(needed)))
+    cuboid = min((cube[name] for name in candidates), key=len)
+    if nbds is not None:
+        # cuboids are sorted by nbhid first, every neighborhood is one run
+        nbhids = cuboid['nbhid'].to_numpy()
+        ids = np.unique([int(nbd) for nbd in nbds])
+        starts, ends = nbhids.searchsorted(ids, 'left'), nbhids.searchsorted(ids, 'right')
+        cuboid = cuboid.take(np.concatenate([np.arange(0)] + [np.arange(start, end)
+                                                              for start, end in zip(starts, ends)]))
+    mask = np.ones(len(cuboid), dtype=bool)
+    for dim, values in filters.items():
+        mask &= cuboid[dim].isin(list(values)).to_numpy()
+    if years_range is not None:
+        years = cuboid['CREATION YEAR'].to_numpy()
+        mask &= (years >= years_range[0]) & (years <= years_range[1])
+    if months_range is not None:
+        months = cuboid['CREATION MONTH'].to_numpy()
+        mask &= (months >= months_range[0]) & (months <= months_range[1])
+    cells = cuboid[mask]
+    if not by:
+        return cells[measures].sum()
+    return cells.groupby(by, observed=True)[measures].sum()
+
+
+def _periods(years, months):
+    return np.asarray(years, dtype=np.int64) * 12 + np.asarray(months, dtype=np.int64) - 1
+
+
+def prefix_sums(cells):
+    """
+    Running totals of the calls, DAYS TO CLOSE sums and counts of every
+    neighborhood over the months, from ``cells``, a frame of those measures
+    by (nbhid, CREATION YEAR, CREATION MONTH): one (nbhid x month) matrix
+    per measure, whose column ``i`` holds the totals of the months before
+    ``first + i`` (months since year 0). The totals of every neighborhood
+    over any range of months are then the difference of two columns.
+    """
+    nbhids, rows = np.unique(cells['nbhid'].to_numpy(), return_inverse=True)
+    periods = _periods(cells['CREATION YEAR'].to_numpy(), cells['CREATION MONTH'].to_numpy())
+    first = int(periods.min()) if len(periods) else 0
+    width = int(periods.max()) - first + 2 if len(periods) else 1
+    prefix = {'nbhids': nbhids, 'first': first}
+    for measure in ['count', 'days_sum', 'days_count']:
+        totals = np.zeros((len(nbhids), width), dtype=np.float64 if measure == 'days_sum' else np.int64)
+        np.add.at(totals, (rows, periods - first + 1), cells[measure].to_numpy())
+        prefix[measure] = np.cumsum(totals, axis=1)
+    return prefix
+
+
+def range_totals(prefix, measure, years_range=None):
+    """
+    The totals of ``measure`` of every neighborhood of ``prefix['nbhids']``
+    over the (inclusive) ``years_range``, with one subtraction
+    """
+    width = prefix[measure].shape[1]
+    if years_range is None:
+        start, end = 0, width - 1
+    else:
+        start, end = np.clip(_periods([years_range[0], years_range[1] + 1], [1, 1]) - prefix['first'], 0, width - 1)
+    return prefix[measure][:, end] - prefix[measure][:, start]
+
+
+def mean_days(prefix, nbds, years_range=None):
+    """
+    {nbhid: mean DAYS TO CLOSE of the calls created within the (inclusive)
+    ``years_range``}. Neighborhoods without a closed call in the range are
+    left out.
+    """
+    sums = range_totals(prefix, 'days_sum', years_range)
+    counts = range_totals(prefix, 'days_count', years_range)
+    nbhids = prefix['nbhids']
+    means = {}
+    for nbd in nbds:
+        row = np.searchsorted(nbhids, int(nbd))
+        if row < len(nbhids) and nbhids[row] == int(nbd) and counts[row] > 0:
+            means[int(nbd)] = float(sums[row] / counts[row])
+    return means
+
+
+if __name__ == "__main__":
+    import dataset  # needs the app dependencies
+
+    dataset.load_cube(sys.argv[1] if sys.argv[1:] else "merged")
@@ -0,0 +1,686 @@
+"""
+Data access shared by the Dash apps.
+
+``load`` keeps one frame per source for the whole process, with the
+nbh_id -> nbhid rename applied, so a process importing two apps holds one
+copy of it; the selection and map helpers below take it as their first
+argument.
+
+Stored frames are sorted by neighborhood, year and month (schema.SORT_KEY),
+and ``index`` keeps CSR style offsets of every neighborhood's run of rows,
+so ``select`` slices the years and months of the selected neighborhoods out
+of their runs with searchsorted, at a cost that follows the selection
+rather than the 1.5M rows. The other filters (department, category, source
+and status) are looked up in compressed bitmaps of their rows (see
+bitmap.py) instead of masking the selected rows. One slider move fires half a dozen callbacks
+with the same filter, so the rows of indexed selections are also kept in a
+small LRU cache shared by all threads (``KC311_SELECTION_CACHE`` entries, 32
+by default), a position array per selection rather than a copy of its calls.
+
+The charts do not select calls at all: they sum the cells of the source's
+cube (see cube.py), loaded once per process by ``load_cube``, through
+``aggregate``, which runs them in SQL instead with KC311_QUERY_ENGINE set
+to sqlite or duckdb.
+
+``get_data`` puts the geobuf of a selection together from the encoded
+calls of each of its neighborhoods and years (see pbf.py), kept in memory
+and under data/snapshot/geobuf, so only the blocks a selection adds are
+encoded.
+
+The map of app.py loads its points tile by tile (see tiles.py):
+``get_tile`` cuts the calls of a selection in one z/x/y tile out of the
+spatially sorted copy of the frame, or their clusters from its cluster
+pyramid (see clusters.py) up to clusters.MAX_ZOOM, and keeps the last
+``KC311_TILE_CACHE`` encoded tiles. The same copy gives ``get_data`` the
+calls within the bounds of a map viewport.
+"""
+import base64
+import collections
+import itertools
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+
+import bitmap
+import clusters
+import cube
+import pbf
+import sketch
+import sqlengine
+import store
+import tiles
+import tracing
+from schema import DERIVED, materialize, sort, stored_columns
+from snapshot import (MANIFEST, NEIGHBORHOODS_SNAPSHOT, SNAPSHOT_PATH, is_fresh, load_merged_calls,
+                      load_neighborhood_calls, merged_manifest, read_manifest, reset_snapshot,
+                      stamp_snapshot)
+
+COLUMNS = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
+           'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
+           'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
+           'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
+           'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL', 'nbh_id', 'nbh_name']
+COLOR_PROP = 'DAYS TO CLOSE'
+# properties of the map points, their tooltip and popup are made of them in the browser (assets/points.js)
+POINT_KEYS = ['NEIGHBORHOOD', COLOR_PROP]
+MAP_COLUMNS = ['LATITUDE', 'LONGITUDE'] + POINT_KEYS
+
+SORT_KEY = ['nbhid', 'CREATION YEAR', 'CREATION MONTH', 'created_ts']
+# the columns selections are sliced on, the frame being sorted by them
+SLICED = SORT_KEY[:3]
+
+SELECTION_CACHE_SIZE = int(os.environ.get("KC311_SELECTION_CACHE", "32"))
+TILE_CACHE_SIZE = int(os.environ.get("KC311_TILE_CACHE", "512"))
+BLOCK_CACHE_BYTES = int(os.environ.get("KC311_BLOCK_CACHE_MB", "64")) * 2 ** 20
+
+BLOCKS_PATH = os.path.join(SNAPSHOT_PATH, "geobuf")
+# bumped when the encoding of the calls changes, the stored blocks are dropped then
+BLOCK_FORMAT = 2
+
+_frames = {}
+# the sources loaded from the store, whose partitions store.query reads
+_stored = set()
+_cubes = {}
+_indexes = {}
+_versions = itertools.count()
+_lock = threading.Lock()
+
+_selections = collections.OrderedDict()
+_pending = {}
+_selection_stats = {'hits': 0, 'misses': 0}
+_selection_lock = threading.Lock()
+
+_tile_stores = {}
+_tiles = collections.OrderedDict()
+_tile_lock = threading.Lock()
+
+_blocks = collections.OrderedDict()
+_block_dirs = {}
+_block_stats = {'bytes': 0}
+_block_lock = threading.Lock()
+
+
+def load(source="merged"):
+    """
+    The 311 calls of ``source``, "merged" (the 2007-2020 dataset or the
+    store, see snapshot.load_merged_calls) or "neighborhoods" (the
+    data/*_neighborhood.csv files), loaded once per process.
+    """
+    with _lock:
+        if source not in _frames:
+            if source == "merged":
+                frame = load_merged_calls()
+                if store.exists():
+                    _stored.add(source)
+            elif source == "neighborhoods":
+                frame = load_neighborhood_calls(usecols=stored_columns(COLUMNS + DERIVED))
+            else:
+                raise ValueError("unknown source %r" % source)
+            # in place, the columns may be memory mapped
+            frame.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
+            _frames[source] = index(frame)
+        return _frames[source]
+
+
+def load_cube(source="merged"):
+    """
+    The cube of the calls of ``source`` (see ``load``), loaded once per
+    process, or their SQL database with KC311_QUERY_ENGINE (see sqlengine.py)
+    """
+    frame = load(source)
+    with _lock:
+        if source not in _cubes:
+            if sqlengine.ENGINE != "pandas":
+                _cubes[source] = sqlengine.connect(frame, sqlengine.ENGINE)
+            else:
+                _cubes[source] = cube.load(frame, source, _sources(source), _partitions(source))
+        return _cubes[source]
+
+
+def _source(frame):
+    """ The ``load`` source ``frame`` is the frame of, None if it is not one """
+    return next((name for name, loaded in _frames.items() if loaded is frame), None)
+
+
+def _sources(source):
+    """ The files the calls of ``source`` are loaded from, which stamp what is derived from them """
+    if source == "merged":
+        return [merged_manifest()]
+    return [os.path.join(NEIGHBORHOODS_SNAPSHOT, MANIFEST)]
+
+
+def _partitions(source):
+    """
+    The store partitions the calls of ``source`` were merged from (see
+    store.merge), None when they were not
+    """
+    if source != "merged":
+        return None
+    manifest = read_manifest(os.path.dirname(merged_manifest()))
+    return None if manifest is None else manifest.get("partitions")
+
+
+def _periods(frame):
+    """ Months since year 0 of the creation dates, the key runs are sorted on """
+    return frame['CREATION YEAR'].to_numpy().astype(np.int32) * 12 + frame['CREATION MONTH'].to_numpy() - 1
+
+
+def index(frame):
+    """
+    Index the rows of ``frame`` for ``select`` and return it, sorted first
+    (as a copy) if it is not in SORT_KEY order yet. The index lives as long
+    as the frame.
+    """
+    nbhids = frame['nbhid'].to_numpy()
+    periods = _periods(frame)
+    if (np.diff(nbhids) < 0).any() or ((np.diff(periods) < 0) & (np.diff(nbhids) == 0)).any():
+        print("sorting %d rows by %s" % (len(frame), ", ".join(SORT_KEY)))
+        frame = sort(frame, SORT_KEY)
+        nbhids, periods = frame['nbhid'].to_numpy(), _periods(frame)
+    starts = np.flatnonzero(np.diff(nbhids)) + 1
+    offsets = np.concatenate([[0], starts, [len(frame)]])
+    _indexes[id(frame)] = {'nbhids': nbhids[offsets[:-1]] if len(frame) else nbhids[:0],
+                           'offsets': offsets, 'periods': periods,
+                           'years': np.unique(frame['CREATION YEAR'].to_numpy()),
+                           'bitmaps': bitmap.build(frame), 'version': next(_versions)}
+    weakref.finalize(frame, _indexes.pop, id(frame), None)
+    return frame
+
+
+def parse_nbds(nbds, default):
+    """
+    The neighborhood ids of a selection, which the apps keep as a JSON list
+    in a Div (or get as a list from a dropdown)
+    """
+    if not nbds:
+        return list(default)
+    if not isinstance(nbds, list):
+        try:
+            nbds = json.loads(nbds)
+        except ValueError:
+            return list(default)
+    return [int(nbd) for nbd in nbds if nbd is not None]
+
+
+def _predicates(nbds, years_range, months_range, filters):
+    """ A selection as {column: allowed values} """
+    predicates = {column: list(values) for column, values in (filters or {}).items()}
+    if nbds is not None:
+        predicates['nbhid'] = [int(nbd) for nbd in nbds]
+    if years_range is not None:
+        predicates['CREATION YEAR'] = list(range(int(years_range[0]), int(years_range[1]) + 1))
+    if months_range is not None:
+        predicates['CREATION MONTH'] = list(range(int(months_range[0]), int(months_range[1]) + 1))
+    return predicates
+
+
+def _masked(frame, predicates):
+    mask = np.ones(len(frame), dtype=bool)
+    for column, values in predicates.items():
+        mask &= frame[column].isin(values).to_numpy()
+    return frame[mask]
+
+
+def _intervals(frame_index, predicates):
+    """
+    The [start, end) periods (see ``_periods``) of the years and months of
+    a selection, ascending, None when it takes all of them
+    """
+    if 'CREATION YEAR' not in predicates and 'CREATION MONTH' not in predicates:
+        return None
+    years = predicates.get('CREATION YEAR', frame_index['years'])
+    months = predicates.get('CREATION MONTH', range(1, 13))
+    periods = np.unique(np.array([int(year) * 12 + int(month) - 1 for year in years for month in months
+                                  if 1 <= int(month) <= 12], dtype=np.int32))
+    if not len(periods):
+        return periods, periods
+    breaks = np.flatnonzero(np.diff(periods) != 1) + 1
+    return periods[np.concatenate([[0], breaks])], periods[np.concatenate([breaks - 1, [len(periods) - 1]])] + 1
+
+
+def _slices(frame_index, predicates):
+    """
+    The [start, end) ranges of the rows of the neighborhoods, years and
+    months of a selection, ascending, searched in the runs of its
+    neighborhoods
+    """
+    nbhids, offsets, periods = frame_index['nbhids'], frame_index['offsets'], frame_index['periods']
+    if 'nbhid' in predicates:
+        runs = np.flatnonzero(np.isin(nbhids, [int(nbd) for nbd in predicates['nbhid']]))
+    else:
+        runs = np.arange(len(nbhids))
+    starts, ends = offsets[runs], offsets[runs + 1]
+    intervals = _intervals(frame_index, predicates)
+    if intervals is not None:
+        low, high = intervals
+        # a run is sorted by period, each interval is one slice of it
+        slices = [(start + periods[start:end].searchsorted(low), start + periods[start:end].searchsorted(high))
+                  for start, end in zip(starts, ends)]
+        starts = np.concatenate([start for start, _ in slices] + [np.zeros(0, dtype=np.int64)])
+        ends = np.concatenate([end for _, end in slices] + [np.zeros(0, dtype=np.int64)])
+    return starts, ends
+
+
+def _ranges(starts, ends):
+    """ The positions of the rows of the [start, end) ranges, in the order of the ranges """
+    lengths = ends - starts
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    # each range picks up numbering where the previous one left off
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+
+
+def _select_rows(frame, frame_index, predicates, record):
+    """ The positions of the rows of ``frame`` a selection matches, ascending """
+    bitmaps = frame_index['bitmaps']
+    indexed = {column: values for column, values in predicates.items()
+               if column not in SLICED and column in bitmaps['columns']}
+    if not indexed:
+        with tracing.stage(record, 'slice'):
+            rows = _ranges(*_slices(frame_index, predicates))
+    else:
+        with tracing.stage(record, 'match'):
+            selected = bitmap.match(bitmaps, indexed)
+            if any(column in predicates for column in SLICED):
+                selected = bitmap.and_(selected, bitmap.from_ranges(*_slices(frame_index, predicates)))
+            rows = bitmap.positions(selected)
+    unindexed = {column: values for column, values in predicates.items()
+                 if column not in SLICED and column not in indexed}
+    if unindexed:
+        with tracing.stage(record, 'scan'):
+            mask = np.ones(len(rows), dtype=bool)
+            for column, values in unindexed.items():
+                mask &= frame[column].take(rows).isin(values).to_numpy()
+            rows = rows[mask]
+    return rows
+
+
+def _select_indexed(frame, frame_index, predicates, record):
+    rows = _select_rows(frame, frame_index, predicates, record)
+    with tracing.stage(record, 'take'):
+        return frame.take(rows)
+
+
+def _selection_key(frame_index, predicates):
+    return (frame_index['version'],
+            frozenset((column, frozenset(values)) for column, values in predicates.items()))
+
+
+def _cached_rows(frame, frame_index, predicates, record):
+    """
+    The rows of a selection from the cache, or computed by this thread while
+    the others asking for the same one wait for it
+    """
+    key = _selection_key(frame_index, predicates)
+    record['cache'] = 'hit'
+    while True:
+        with _selection_lock:
+            if key in _selections:
+                _selections.move_to_end(key)
+                _selection_stats['hits'] += 1
+                return _selections[key]
+            pending = _pending.get(key)
+            if pending is None:
+                pending = _pending[key] = threading.Event()
+                _selection_stats['misses'] += 1
+                break
+        # computed by another thread; look again, it may have failed
+        record['cache'] = 'wait'
+        with tracing.stage(record, 'wait'):
+            pending.wait()
+    record['cache'] = 'miss'
+    try:
+        rows = _select_rows(frame, frame_index, predicates, record)
+        with _selection_lock:
+            _selections[key] = rows
+            while len(_selections) > SELECTION_CACHE_SIZE:
+                _selections.popitem(last=False)
+        return rows
+    finally:
+        with _selection_lock:
+            _pending.pop(key).set()
+
+
+def selection_cache_info():
+    """ Hits, misses and size of the selection cache """
+    with _selection_lock:
+        return dict(_selection_stats, size=len(_selections), maxsize=SELECTION_CACHE_SIZE)
+
+
+def select(frame, nbds=None, years_range=None, months_range=None, filters=None):
+    """
+    The calls of ``nbds`` created within the (inclusive) year and month
+    ranges, and matching ``filters``, {column: allowed values} (e.g.
+    {'STATUS': ['OPEN']}). The rows of the selections of an indexed frame
+    are cached.
+    """
+    predicates = _predicates(nbds, years_range, months_range, filters)
+    frame_index = _indexes.get(id(frame))
+    with tracing.span('select', nbds=nbds, years_range=years_range, months_range=months_range,
+                      filters=filters) as record:
+        if frame_index is None:
+            record['path'] = 'scan'
+            selected = _masked(frame, predicates)
+        else:
+            record['path'] = 'index'
+            if SELECTION_CACHE_SIZE > 0:
+                rows = _cached_rows(frame, frame_index, predicates, record)
+            else:
+                rows = _select_rows(frame, frame_index, predicates, record)
+            with tracing.stage(record, 'take'):
+                selected = frame.take(rows)
+        record['rows'] = len(selected)
+    return selected
+
+
+def export(frame):
+    """ Selected rows as they are downloaded: virtual columns rebuilt, derived ones dropped """
+    frame = materialize(frame.rename(columns={'nbhid': 'nbh_id'}))
+    return frame.drop(columns=[col for col in DERIVED if col in frame.columns])
+
+
+def export_selection(frame, nbds, years_range=None):
+    """
+    The calls of ``nbds`` created within ``years_range`` as they are
+    downloaded (see ``export``). For the frame of a source loaded from the
+    store, they are read from their partitions only (see store.query).
+    """
+    with tracing.span('export', nbds=nbds, years_range=years_range) as record:
+        if _source(frame) in _stored:
+            record['path'] = 'store'
+            with tracing.stage(record, 'query'):
+                selected = store.query(nbds, years_range)
+        else:
+            record['path'] = 'select'
+            with tracing.stage(record, 'select'):
+                selected = select(frame, nbds, years_range)
+        with tracing.stage(record, 'export'):
+            exported = export(selected)
+        record['rows'] = len(exported)
+    return exported
+
+
+def nbh_names(frame):
+    """ {nbhid: neighborhood name} """
+    return frame.groupby('nbhid')['nbh_name'].first().to_dict()
+
+
+def aggregate(calls_cube, by, nbds=None, years_range=None, months_range=None, measures='count',
+              filters=None):
+    """ cube.query over what ``load_cube`` returned, whatever the query engine """
+    with tracing.span('aggregate', by=by, nbds=nbds, years_range=years_range, months_range=months_range,
+                      measures=measures, filters=filters) as record:
+        if sqlengine.is_database(calls_cube):
+            record['path'] = calls_cube['engine']
+            result = sqlengine.query(calls_cube, by, nbds, years_range, months_range, measures, filters)
+        else:
+            record['path'] = 'cube'
+            result = cube.query(calls_cube, by, nbds, years_range, months_range, measures, filters)
+        record['rows'] = len(result) if by else 1
+    return result
+
+
+def volumes(totals, years_range, nbds=None):
+    """ {nbhid: number of calls created within ``years_range``}, from ``running_totals`` """
+    counts = cube.range_totals(totals, 'count', years_range)
+    keep = counts > 0
+    if nbds is not None:
+        keep &= np.isin(totals['nbhids'], [int(nbd) for nbd in nbds])
+    return dict(zip(totals['nbhids'][keep].tolist(), counts[keep].tolist()))
+
+
+def volume_classes(volumes, count=5):
+    """ Class breaks of the outline colorscale, ``count`` equal steps from the lowest volume """
+    values = np.fromiter(volumes.values(), dtype=np.int64)
+    if not len(values):
+        return [0]
+    low, high = int(values.min()), int(values.max())
+    return list(range(low, high, max((high - low) // count, 1))) or [low]
+
+
+def _features(df_nbh):
+    """ The located calls of ``df_nbh`` as geobuf features, with the POINT_KEYS properties """
+    lat = df_nbh['LATITUDE'].to_numpy(dtype=float)
+    lon = df_nbh['LONGITUDE'].to_numpy(dtype=float)
+    located = ~np.isnan(lat) & ~np.isnan(lon)
+    return pbf.features(lat[located], lon[located], [df_nbh[key][located] for key in POINT_KEYS])
+
+
+def _geobuf(df_nbh, record):
+    """ The calls of ``df_nbh`` as geobuf points (bytes) """
+    with tracing.stage(record, 'geobuf'):
+        data = pbf.join(POINT_KEYS, [_features(df_nbh)])
+    record['rows'] = len(df_nbh)
+    return data
+
+
+def _clusters_geobuf(df_clusters, record):
+    """ The clusters of ``df_clusters`` (see clusters.py) as geobuf points (bytes) """
+    with tracing.stage(record, 'geobuf'):
+        data = pbf.points(df_clusters['LATITUDE'].to_numpy(), df_clusters['LONGITUDE'].to_numpy(),
+                          [(key, df_clusters[key].to_numpy(dtype=float)) for key in ['point_count', COLOR_PROP]])
+    record['rows'] = len(df_clusters)
+    return data
+
+
+def _blocks_dir(frame):
+    """
+    The directory of the stored blocks of ``frame`` if it is the frame of a
+    ``load`` source, emptied when BLOCK_FORMAT or the source changed, or
+    only of the blocks of the store partitions that changed
+    """
+    source = _source(frame)
+    if source is None:
+        return None
+    with _block_lock:
+        if source not in _block_dirs:
+            path = os.path.join(BLOCKS_PATH, source)
+            manifest = read_manifest(path)
+            partitions = _partitions(source)
+            try:
+                stale = not is_fresh(path, _sources(source))
+                if (manifest is None or manifest.get("blocks") != BLOCK_FORMAT
+                        or stale and (partitions is None or manifest.get("partitions") is None)):
+                    reset_snapshot(path, _sources(source), extra={"blocks": BLOCK_FORMAT, "partitions": partitions})
+                elif stale:
+                    for year, nbhid in store.changed(manifest["partitions"], partitions):
+                        block = os.path.join(path, "%d-%d.pbf" % (nbhid, year))
+                        if os.path.exists(block):
+                            os.remove(block)
+                    stamp_snapshot(path, _sources(source), extra={"partitions": partitions})
+            except OSError as e:
+                print("could not store the %s geobuf blocks: %s" % (source, e))
+                path = None
+            _block_dirs[source] = path
+        return _block_dirs[source]
+
+
+def _block(frame, frame_index, nbhid, year, blocks_dir, counts, stored):
+    """
+    The encoded features of the calls of ``nbhid`` created in ``year``,
+    from memory, from ``blocks_dir`` or encoded (and kept in both). When
+    ``stored``, the calls are read from their store partition, which is
+    the block.
+    """
+    key = (frame_index['version'], nbhid, year)
+    with _block_lock:
+        features = _blocks.get(key)
+        if features is not None:
+            _blocks.move_to_end(key)
+            counts['memory'] += 1
+            return features
+    path = None if blocks_dir is None else os.path.join(blocks_dir, "%d-%d.pbf" % (nbhid, year))
+    if path is not None and os.path.exists(path):
+        with open(path, "rb") as block_file:
+            features = block_file.read()
+        counts['disk'] += 1
+    else:
+        if stored:
+            calls = store.query([nbhid], [year, year], columns=MAP_COLUMNS)
+        else:
+            scratch = {'stages': {}}
+            calls = _select_indexed(frame, frame_index, _predicates([nbhid], [year, year], None, None), scratch)
+        features = _features(calls)
+        counts['encoded'] += 1
+        if path is not None:
+            try:
+                with open(path + ".tmp-%d" % os.getpid(), "wb") as block_file:
+                    block_file.write(features)
+                os.replace(path + ".tmp-%d" % os.getpid(), path)
+            except OSError as e:
+                print("could not store the geobuf block %s: %s" % (path, e))
+    with _block_lock:
+        if key not in _blocks:
+            _blocks[key] = features
+            _block_stats['bytes'] += len(features)
+        while _block_stats['bytes'] > BLOCK_CACHE_BYTES and len(_blocks) > 1:
+            _block_stats['bytes'] -= len(_blocks.popitem(last=False)[1])
+    return features
+
+
+def get_data(frame, nbds, years_range=None, bounds=None):
+    """
+    The calls of ``nbds`` as geobuf points for the map. Within ``bounds``,
+    [[south, west], [north, east]], they are searched in the spatially
+    sorted copy of the frame (see tiles.py). For an indexed frame, all of
+    them are put together from the encoded calls of each of their
+    neighborhoods and years, kept in memory (up to
+    ``KC311_BLOCK_CACHE_MB``, 64 by default) and on disk, so a change of
+    the selection only encodes the blocks it adds.
+    """
+    with tracing.span('geojson', nbds=nbds, years_range=years_range, bounds=bounds) as record:
+        frame_index = _indexes.get(id(frame))
+        if bounds is not None:
+            record['path'] = 'bounds'
+            store = tile_store(frame)
+            with tracing.stage(record, 'select'):
+                points = tiles.points_in_bounds(store, bounds)
+                points = _masked(points, _predicates(nbds, years_range, None, None))
+            data = _geobuf(points, record)
+        elif frame_index is None:
+            record['path'] = 'scan'
+            with tracing.stage(record, 'select'):
+                df_nbh = select(frame, nbds, years_range)
+            data = _geobuf(df_nbh, record)
+        else:
+            record['path'] = 'blocks'
+            nbhids = frame_index['nbhids'].tolist()
+            if nbds is not None:
+                nbhids = sorted(set(int(nbd) for nbd in nbds) & set(nbhids))
+            years = [year for year in frame_index['years'].tolist()
+                     if years_range is None or years_range[0] <= year <= years_range[1]]
+            blocks_dir = _blocks_dir(frame)
+            stored = _source(frame) in _stored
+            counts = record['blocks'] = {'memory': 0, 'disk': 0, 'encoded': 0}
+            with tracing.stage(record, 'blocks'):
+                parts = [_block(frame, frame_index, nbhid, year, blocks_dir, counts, stored)
+                         for nbhid in nbhids for year in years]
+            with tracing.stage(record, 'join'):
+                data = pbf.join(POINT_KEYS, parts)
+            record['bytes'] = len(data)
+    return base64.b64encode(data).decode()
+
+
+def tile_store(frame):
+    """ The calls of ``frame`` sorted for tiling (see tiles.py), built on first use """
+    with _lock:
+        if id(frame) not in _tile_stores:
+            store = tiles.build(frame)
+            store['version'] = next(_versions)
+            _tile_stores[id(frame)] = store
+            weakref.finalize(frame, _tile_stores.pop, id(frame), None)
+        return _tile_stores[id(frame)]
+
+
+def cluster_pyramid(frame):
+    """ The cluster pyramid of the located calls of ``frame`` (see clusters.py), built on first use """
+    store = tile_store(frame)
+    with _lock:
+        if 'pyramid' not in store:
+            store['pyramid'] = clusters.build(store['points'])
+        return store['pyramid']
+
+
+def get_tile(frame, z, x, y, nbds=None, years_range=None):
+    """
+    The calls of ``nbds`` created within ``years_range`` in tile z/x/y, as
+    geobuf points (bytes), or their clusters up to
+    clusters.MAX_ZOOM. The last ``KC311_TILE_CACHE`` tiles (512 by
+    default) are kept.
+    """
+    store = tile_store(frame)
+    key = (store['version'], z, x, y, None if nbds is None else frozenset(int(nbd) for nbd in nbds),
+           None if years_range is None else tuple(int(year) for year in years_range))
+    with tracing.span('tile', tile=[z, x, y], nbds=nbds, years_range=years_range) as record:
+        with _tile_lock:
+            data = _tiles.get(key)
+            if data is not None:
+                _tiles.move_to_end(key)
+        record['cache'] = 'miss' if data is None else 'hit'
+        if data is None:
+            if z <= clusters.MAX_ZOOM:
+                record['path'] = 'clusters'
+                pyramid = cluster_pyramid(frame)
+                with tracing.stage(record, 'select'):
+                    df_clusters = clusters.tile_clusters(pyramid, z, x, y, nbds, years_range)
+                data = _clusters_geobuf(df_clusters, record)
+            else:
+                record['path'] = 'points'
+                with tracing.stage(record, 'select'):
+                    points = tiles.tile_points(store, z, x, y)
+                    points = _masked(points, _predicates(nbds, years_range, None, None))
+                data = _geobuf(points, record)
+            with _tile_lock:
+                _tiles[key] = data
+                while len(_tiles) > TILE_CACHE_SIZE:
+                    _tiles.popitem(last=False)
+        record['bytes'] = len(data)
+    return data
+
+
+def tile_extent(frame):
+    """ [[south, west], [north, east]] of the located calls of ``frame`` """
+    return tile_store(frame)['extent']
+
+
+def running_totals(calls_cube):
+    """
+    Running call counts and DAYS TO CLOSE totals of every neighborhood over
+    the months (see cube.prefix_sums), for ``volumes`` and ``mean_response``
+    """
+    cells = aggregate(calls_cube, ['nbhid', 'CREATION YEAR', 'CREATION MONTH'],
+                      measures=['count', 'days_sum', 'days_count'])
+    return cube.prefix_sums(cells.reset_index())
+
+
+def mean_response(totals, nbds, years_range=None):
+    """ {nbhid: mean DAYS TO CLOSE of the calls of ``nbds`` created within ``years_range``} """
+    return cube.mean_days(totals, nbds, years_range)
+
+
+def days_quantiles(calls_cube, qs, nbds=None, years_range=None, months_range=None, departments=None):
+    """
+    {q: approximate DAYS TO CLOSE quantile} of the closed calls of the
+    selection, from the merged sketches of its cells (see sketch.py)
+    """
+    filters = None if departments is None else {'DEPARTMENT': list(departments)}
+    counts = aggregate(calls_cube, ['days_bucket'], nbds, years_range, months_range, filters=filters)
+    return sketch.quantiles(counts, qs)
+
+
+def get_minmax(calls_cube, nbds, years_range=None):
+    """
+    Colorbar range for the calls of ``nbds`` created within ``years_range``,
+    up to their 95th percentile response time: the few cases open for years
+    would leave the rest of the scale unused
+    """
+    p95 = days_quantiles(calls_cube, [0.95], nbds, years_range)[0.95]
+    return dict(min=0, max=p95 or 0)
+
+
+def get_log_minmax(frame, nbhid):
+    """ Colorbar range of the dl_app scripts, up to the log of the slowest call """
+    return dict(min=0, max=np.log(select(frame, [nbhid])[COLOR_PROP].max()))
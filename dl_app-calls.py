@@ -1,25 +1,17 @@
-import json, os, pathlib
+import json, pathlib
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_leaflet as dl
-import dash_leaflet.express as dlx
-import pandas as pd
-import numpy as np
 from dash_extensions.javascript import Namespace
 from dash import Dash
 from dash.dependencies import Input, Output
+import dataset
 
 # region Data
 APP_PATH = str(pathlib.Path(__file__).parent.resolve())
-cols = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE',
-       'CATEGORY', 'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME',
-       'CREATION MONTH', 'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME',
-       'CLOSED DATE', 'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
-       'ZIP CODE', 'NEIGHBORHOOD', 'LATITUDE', 'LONGITUDE', 'COUNTY', 'CASE URL', 'nbh_id', 'nbh_name']
-df = pd.concat([pd.read_csv(os.path.join(APP_PATH, os.path.join("data", nbh)), usecols=cols)
-                for nbh in os.listdir(os.path.join(APP_PATH, "data")) if nbh.endswith('.csv')])
-df.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
-color_prop = 'DAYS TO CLOSE'
+df = dataset.load("neighborhoods")
+calls_cube = dataset.load_cube("neighborhoods")
+color_prop = dataset.COLOR_PROP
 
 def header_section():
     return html.Div(
@@ -31,21 +23,11 @@ def header_section():
     )
 
 def get_data(nbhid, years_range):
-    df_nbh = df[df["nbhid"] == nbhid]  # pick one state
-    df_nbh = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1]) & (df_nbh['CREATION YEAR'] >= years_range[0])]
-    df_nbh = df_nbh[['LATITUDE', 'LONGITUDE', 'NEIGHBORHOOD', 'DAYS TO CLOSE']]  # use only relevant columns
-    dicts = df_nbh.to_dict('rows')
-    for item in dicts:
-        item["tooltip"] = "{:.1f}".format(item[color_prop])  # bind tooltip
-        item["popup"] = item["NEIGHBORHOOD"]  # bind popup
-    geojson = dlx.dicts_to_geojson(dicts, lat="LATITUDE", lon="LONGITUDE")  # convert to geojson
-    geobuf = dlx.geojson_to_geobuf(geojson)  # convert to geobuf
-    return geobuf
+    return dataset.get_data(df, [nbhid], years_range)
 
 
 def get_minmax(nbhid):
-    df_state = df[df["nbhid"] == nbhid]  # pick one neighborhood
-    return dict(min=0, max=np.log(df_state[color_prop].max()))
+    return dataset.get_log_minmax(df, nbhid)
 
 
 # Setup a few color scales.
@@ -67,12 +49,14 @@ dd_state = dcc.Dropdown(options=state_options, value=default_state, id="dd_state
 minmax = get_minmax(default_state)
 # Create geojson.
 ns = Namespace("dlx", "scatter")
+point_ns = Namespace("kc311", "points")
 geojson = dl.GeoJSON(data=get_data(default_state, [2015, 2020]), id="geojson", format="geobuf",
                      zoomToBounds=True,  # when true, zooms to bounds when data changes
                      cluster=True,  # when true, data are clustered
                      clusterToLayer=ns("clusterToLayer"),  # how to draw clusters
                      zoomToBoundsOnClick=True,  # when true, zooms to bounds of feature (e.g. cluster) on click
-                     options=dict(pointToLayer=ns("pointToLayer")),  # how to draw points
+                     options=dict(pointToLayer=ns("pointToLayer"),
+                                  onEachFeature=point_ns("onEachFeature")),  # how to draw points and their tooltips
                      superClusterOptions=dict(radius=150),  # adjust cluster size
                      hideout=dict(colorscale=csc_map[default_csc], colorProp=color_prop, **minmax))
 # Create a colorbar.
@@ -124,8 +108,7 @@ app.layout = html.Div([
     [Input('year_slider', 'value'), Input('dd_state', 'value')])
 def update_trends_graph(years_range, nbhid):
     x = list(range(years_range[0], years_range[1] + 1))
-    df_nbh = df[df["nbhid"] == int(nbhid)]  # pick one state
-    y = df_nbh[(df_nbh['CREATION YEAR'] <= years_range[1]) & (df_nbh['CREATION YEAR'] >= years_range[0])].groupby(['CREATION YEAR'])['CASE ID'].count().tolist()
+    y = dataset.aggregate(calls_cube, ['CREATION YEAR'], [nbhid], years_range).tolist()  # pick one state
     print(len(y))
     return {
         'data': [dict({'x': x, 'y': y, 'type': 'bar', 'name': '311 Calls Trend'})],
@@ -0,0 +1,48 @@
+"""
+Figure builders shared by the chart callbacks.
+
+``series_matrix`` pivots the counts of the department and category charts
+into one dense (series x year) array in a single pass, the years without
+calls included as zeros, so every series lines up with the x axis, and
+``year_lines`` emits a trace per row.
+"""
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+
+def series_matrix(counts, years):
+    """
+    (names, matrix) of ``counts``, a series indexed by (series name, year):
+    one row per series, in index order, and one column per year of
+    ``years``, 0 where a series has no calls. Years outside ``years`` are
+    left out.
+    """
+    years = np.asarray(years)
+    codes, names = pd.factorize(counts.index.get_level_values(0), sort=True)
+    count_years = counts.index.get_level_values(1).to_numpy()
+    columns = np.clip(np.searchsorted(years, count_years), 0, max(len(years) - 1, 0))
+    inside = (codes >= 0) & (years[columns] == count_years) if len(years) else codes < 0
+    matrix = np.zeros((len(names), len(years)), dtype=np.int64)
+    np.add.at(matrix, (codes[inside], columns[inside]), counts.to_numpy()[inside])
+    return [str(name) for name in names], matrix
+
+
+def year_lines(names, matrix, years, colors):
+    """ One markers+lines trace per row of ``matrix`` """
+    return [
+        go.Scatter(
+            x=list(years),
+            y=row.tolist(),
+            name=name,
+            mode="markers+lines",
+            hovertemplate="<b>" + name + ": </b> %{y}",
+            marker=dict(
+                size=12,
+                opacity=0.8,
+                color=colors[ind % len(colors)],
+                line=dict(width=1, color="#ffffff"),
+            ),
+        )
+        for ind, (name, row) in enumerate(zip(names, matrix))
+    ]
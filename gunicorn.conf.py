@@ -0,0 +1,25 @@
+"""
+gunicorn settings for the dashboard (see Procfile).
+
+With KC311_SHARED_DATA=1 the master publishes the 311 snapshot to shared
+memory and imports the app once before forking. Workers inherit the memory
+mapped frame instead of each loading their own copy, so adding workers no
+longer multiplies the data footprint. With KC311_WARMUP=1 as well, the
+master also loads the NLP datasets before forking, which the workers then
+share copy-on-write (without preloading, each worker loads them, see
+app.py).
+"""
+import snapshot
+
+preload_app = snapshot.SHARED
+
+
+def on_starting(server):
+    if snapshot.SHARED:
+        # publishes the snapshot (or the store) without mapping any column
+        snapshot.load_merged_calls(usecols=[])
+    if server.cfg.preload_app:
+        import app  # already imported by the master, see preload_app
+        if app.WARMUP:
+            # not in a thread: the workers would be forked from a half loaded master
+            app.warm_up()
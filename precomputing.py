@@ -1,6 +1,5 @@
 import pathlib
 import pandas as pd
-from ldacomplaints import lda_analysis
 from wordcloud import STOPWORDS
 import re
 import json
@@ -8,7 +7,6 @@ import json
 DATA_PATH = pathlib.Path(__file__).parent.resolve()
 EXTERNAL_STYLESHEETS = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 FILENAME = "data/customer_complaints_narrative_sample.csv"
-GLOBAL_DF = pd.read_csv(DATA_PATH.joinpath(FILENAME), header=0)
 
 """
 In order to make the graphs more useful we decided to prevent some words from being included
@@ -48,7 +46,10 @@ def add_stopwords(selected_bank):
 def precompute_all_lda():
     """ QD function for precomputing all necessary LDA results
      to allow much faster load times when the app runs. """
+    # imported here so that app.py can use add_stopwords without loading spacy
+    from ldacomplaints import lda_analysis
 
+    GLOBAL_DF = pd.read_csv(DATA_PATH.joinpath(FILENAME), header=0)
     failed_banks = []
     counter = 0
     bank_names = GLOBAL_DF["Company"].value_counts().keys().tolist()
@@ -0,0 +1,261 @@
+"""
+Column schema for the 311 calls frame.
+
+``read_dtypes`` has read_csv parse the repetitive strings as categoricals,
+and ``compact`` downcasts years, months, ids and coordinates, which cuts the
+footprint of the frame (held once per gunicorn worker) several-fold.
+It also parses the creation time and dates once, into the ``DERIVED``
+columns the callbacks filter and group on, and drops the ``VIRTUAL``
+columns, which ``materialize`` rebuilds for the rows that get exported.
+"""
+import numpy as np
+import pandas as pd
+
+# Bump whenever the dtypes below change so stored snapshots are rebuilt.
+SCHEMA_VERSION = 4
+
+# Strings that repeat across calls. Most have a few hundred distinct values;
+# the dates a few thousand and STREET ADDRESS one per 6 calls or so, still
+# a fraction of the size of one string object per row.
+CATEGORICAL = ['SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE', 'CATEGORY',
+               'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME', 'STATUS',
+               'EXCEEDED EST TIMEFRAME', 'CLOSED DATE', 'STREET ADDRESS', 'NEIGHBORHOOD',
+               'COUNTY', 'POLICE DISTRICT', 'nbh_name']
+
+# Added by ``derive``: the hour of the call (int8, -1 when unknown) and the
+# creation / closing timestamps (datetime64, NaT when unknown).
+DERIVED = ['hour', 'created_ts', 'closed_ts']
+
+# Row order of stored frames, so the calls of a neighborhood within a date
+# range are one contiguous run of rows (see dataset.select).
+SORT_KEY = ['nbh_id', 'CREATION YEAR', 'CREATION MONTH', 'created_ts']
+
+# Integer targets fall back to float32 when the column has missing values.
+NUMERIC = {
+    'nbh_id': 'int16',
+    'nbhid': 'int16',
+    'CREATION YEAR': 'int16',
+    'CREATION MONTH': 'int8',
+    'CLOSED YEAR': 'int16',
+    'CLOSED MONTH': 'int8',
+    'COUNCIL DISTRICT': 'int8',
+    'ZIP CODE': 'int32',
+    'DAYS TO CLOSE': 'float32',
+    # float64, so ADDRESS WITH GEOCODE can be rebuilt with every digit
+    'LATITUDE': 'float64',
+    'LONGITUDE': 'float64',
+    '30-60-90 Days Open Window': 'float32',
+}
+
+
+def read_dtypes(columns):
+    """
+    Dtypes read_csv can parse ``columns`` into directly. Integer targets are
+    left out, a single missing value would make read_csv fail on them.
+    """
+    dtypes = {}
+    for col in columns:
+        if col in CATEGORICAL:
+            dtypes[col] = 'category'
+        elif col in NUMERIC and np.dtype(NUMERIC[col]).kind == 'f':
+            dtypes[col] = NUMERIC[col]
+    return dtypes
+
+CASE_URL_PREFIX = "http://city.kcmo.org/kc/ActionCenterRequest/CaseInfo.aspx?CaseID="
+
+# Header of the merged CSV, the column order of exported rows.
+SOURCE_COLUMNS = ['CASE ID', 'SOURCE', 'DEPARTMENT', 'WORK GROUP', 'REQUEST TYPE', 'CATEGORY',
+                  'TYPE', 'DETAIL', 'CREATION DATE', 'CREATION TIME', 'CREATION MONTH',
+                  'CREATION YEAR', 'STATUS', 'EXCEEDED EST TIMEFRAME', 'CLOSED DATE',
+                  'CLOSED MONTH', 'CLOSED YEAR', 'DAYS TO CLOSE', 'STREET ADDRESS',
+                  'ADDRESS WITH GEOCODE', 'ZIP CODE', 'NEIGHBORHOOD', 'COUNTY',
+                  'COUNCIL DISTRICT', 'POLICE DISTRICT', 'PARCEL ID NO', 'LATITUDE',
+                  'LONGITUDE', 'CASE URL', '30-60-90 Days Open Window', 'nbh_id', 'nbh_name']
+
+
+def _coordinate(values):
+    # 39.05361 rather than 39.053610, as in the source data
+    return pd.Series(np.char.mod('%.6f', values)).str.rstrip('0').str.rstrip('.').to_numpy(dtype=object)
+
+
+def _case_url(frame):
+    return (CASE_URL_PREFIX + frame['CASE ID'].astype(str)).to_numpy(dtype=object)
+
+
+def _address_with_geocode(frame):
+    zips = frame['ZIP CODE'].to_numpy(dtype=float)
+    zips = np.where(np.isnan(zips), '', np.char.mod('%d', np.nan_to_num(zips)))
+    address = frame['STREET ADDRESS'].astype(object).to_numpy()
+    return (address + zips + '\n(' + _coordinate(frame['LATITUDE'].to_numpy(dtype=float))
+            + ', ' + _coordinate(frame['LONGITUDE'].to_numpy(dtype=float)) + ')')
+
+
+def _closed_part(part):
+    def rule(frame):
+        closed = pd.DatetimeIndex(frame['closed_ts'].to_numpy())
+        values = getattr(closed, part).to_numpy(dtype=float)
+        # cancelled cases keep their closed date, but not its month and year
+        return np.where(frame['STATUS'].astype(object).to_numpy() == 'CANC', np.nan, values)
+    return rule
+
+
+# Redundant columns, dropped by ``compact`` and rebuilt by ``materialize``
+# from the columns they are a function of: {name: (inputs, rule)}. The values
+# the rule gets wrong (e.g. an address typed over two lines, or a month
+# given to a cancelled case) are kept as strings in a mostly empty
+# "<name> exceptions" categorical, which every frame with the inputs has.
+VIRTUAL = {
+    'CASE URL': (['CASE ID'], _case_url),
+    'ADDRESS WITH GEOCODE': (['STREET ADDRESS', 'ZIP CODE', 'LATITUDE', 'LONGITUDE'],
+                             _address_with_geocode),
+    'CLOSED MONTH': (['closed_ts', 'STATUS'], _closed_part('month')),
+    'CLOSED YEAR': (['closed_ts', 'STATUS'], _closed_part('year')),
+}
+EXCEPTIONS = "%s exceptions"
+# the exception of a missing value the rule would fill in, read_csv never
+# gives an empty string
+MISSING = ""
+CATEGORICAL += [EXCEPTIONS % name for name in VIRTUAL]
+
+
+def stored_columns(columns):
+    """ The stored columns needed to serve ``columns``, virtual ones included """
+    stored = []
+    for col in columns:
+        needed = VIRTUAL[col][0] + [EXCEPTIONS % col] if col in VIRTUAL else [col]
+        stored.extend(needed_col for needed_col in needed if needed_col not in stored)
+    return stored
+
+
+def virtualize(frame):
+    """ Replaces the ``VIRTUAL`` columns of ``frame`` with their exceptions """
+    for name, (inputs, rule) in VIRTUAL.items():
+        if name not in frame.columns or not all(col in frame.columns for col in inputs):
+            continue
+        values = frame[name].astype(object).to_numpy()
+        rebuilt = rule(frame)
+        missing = pd.isna(values)
+        wrong = ~missing & (pd.isna(rebuilt) | (values != rebuilt))
+        exceptions = np.full(len(frame), None, dtype=object)
+        exceptions[wrong] = [str(value) for value in values[wrong]]
+        exceptions[missing & ~pd.isna(rebuilt)] = MISSING
+        frame = frame.drop(columns=name)
+        frame[EXCEPTIONS % name] = pd.Categorical(exceptions)
+    return frame
+
+
+def materialize(frame):
+    """
+    ``frame`` with its virtual columns rebuilt and in the column order of the
+    merged CSV, for exporting it
+    """
+    frame = frame.copy()
+    for name, (inputs, rule) in VIRTUAL.items():
+        exceptions = EXCEPTIONS % name
+        if exceptions not in frame.columns or not all(col in frame.columns for col in inputs):
+            continue
+        values = frame[exceptions].astype(object).to_numpy()
+        rebuilt = np.asarray(rule(frame))
+        excepted = ~pd.isna(values)
+        column = rebuilt.copy() if rebuilt.dtype.kind == 'f' else rebuilt.astype(object)
+        column[excepted] = [np.nan if value == MISSING else float(value) if rebuilt.dtype.kind == 'f' else value
+                            for value in values[excepted]]
+        frame[name] = column
+        frame = frame.drop(columns=exceptions)
+    order = [col for col in SOURCE_COLUMNS if col in frame.columns]
+    return frame[order + [col for col in frame.columns if col not in order]]
+
+
+def memory_mb(frame):
+    return frame.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def target_dtypes(frame):
+    """ The dtype each column of ``frame`` should be stored as """
+    dtypes = {}
+    for col in frame.columns:
+        if col in CATEGORICAL:
+            if not isinstance(frame[col].dtype, pd.CategoricalDtype):
+                dtypes[col] = 'category'
+        elif col in NUMERIC:
+            dtype = np.dtype(NUMERIC[col])
+            if dtype.kind == 'i' and frame[col].isna().any():
+                dtype = np.dtype('float32')
+            if frame[col].dtype != dtype:
+                dtypes[col] = dtype
+    return dtypes
+
+
+def parse_datetimes(column, format):
+    """
+    pd.to_datetime over the distinct values of ``column`` only, spread back
+    to the rows through the categorical codes.
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype('category')
+    # in microseconds whatever pandas infers, which differs when there are no values at all
+    parsed = pd.to_datetime(pd.Series(column.cat.categories.astype(object)),
+                            format=format, errors='coerce').to_numpy().astype('datetime64[us]')
+    # the extra trailing NaT is what code -1 picks up, also when there are no values
+    return np.append(parsed, np.array(['NaT'], dtype=parsed.dtype))[column.cat.codes.to_numpy()]
+
+
+def derive(frame):
+    """ Adds the ``DERIVED`` columns of the source columns ``frame`` has """
+    derived = {}
+    if 'CREATION TIME' in frame.columns:
+        times = parse_datetimes(frame['CREATION TIME'], '%I:%M %p')
+        hours = pd.DatetimeIndex(times).hour.to_numpy()
+        derived['hour'] = np.where(np.isnat(times), -1, hours).astype('int8')
+        if 'CREATION DATE' in frame.columns:
+            derived['created_ts'] = (parse_datetimes(frame['CREATION DATE'], '%m/%d/%Y')
+                                     + (times - np.datetime64('1900-01-01')))
+    if 'CLOSED DATE' in frame.columns:
+        derived['closed_ts'] = parse_datetimes(frame['CLOSED DATE'], '%m/%d/%Y')
+    return frame.assign(**derived)
+
+
+def compact(frame, name="311 calls"):
+    """
+    Returns ``frame`` with the schema dtypes applied, the derived columns
+    added and the virtual ones dropped, and reports the saving
+    """
+    before = memory_mb(frame)
+    frame = virtualize(derive(frame.astype(target_dtypes(frame))))
+    print("compacted %s frame: %.1f MB as parsed -> %.1f MB" % (name, before, memory_mb(frame)))
+    return frame
+
+
+def sort(frame, key=SORT_KEY):
+    """ ``frame`` in ``key`` order (by the columns of ``key`` it has) """
+    by = [col for col in key if col in frame.columns]
+    return frame.sort_values(by, kind='mergesort').reset_index(drop=True) if by else frame
+
+
+def concat(frames):
+    """
+    pd.concat that keeps categorical columns categorical even when the
+    frames were compacted separately (and so have different categories).
+    """
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+    data = {}
+    for col in frames[0].columns:
+        columns = [frame[col] for frame in frames]
+        if all(isinstance(column.dtype, pd.CategoricalDtype) for column in columns):
+            # recode every frame against the union of the categories, much
+            # cheaper than union_categoricals over hundreds of partitions
+            categories = [np.asarray(column.cat.categories, dtype=object) for column in columns]
+            union = pd.Index(np.concatenate(categories)).unique()
+            codes = []
+            for column, column_categories in zip(columns, categories):
+                # the trailing -1 is what code -1 picks up
+                recode = np.append(union.get_indexer(column_categories), -1)
+                codes.append(recode[column.cat.codes.to_numpy()])
+            data[col] = pd.Categorical.from_codes(np.concatenate(codes), union)
+        else:
+            data[col] = np.concatenate([column.to_numpy() for column in columns])
+    frame = pd.DataFrame(data, columns=frames[0].columns)
+    # e.g. int32 and float32 parts of an integer column concatenate to float64
+    return frame.astype(target_dtypes(frame))
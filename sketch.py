@@ -0,0 +1,48 @@
+"""
+Mergeable quantile sketches of DAYS TO CLOSE.
+
+Means of the closure time are dominated by the few cases that stay open for
+years, so the apps also need medians and high percentiles, for any set of
+neighborhoods, departments and months. Each call is counted in a
+logarithmic bucket of its DAYS TO CLOSE (as in DDSketch): bucket ``i``
+holds the values in (GAMMA ** (i - 1), GAMMA ** i], so reading a bucket back
+as ``value(i)`` is off by at most RELATIVE_ACCURACY. The sketch of a cell is
+its bucket counts, and merging the sketches of a selection is adding them
+up, which the cube does (see the "days" cuboid in cube.py).
+"""
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+# calls closed the day they were opened (and bad negative values)
+ZERO_BUCKET = -2 ** 15
+
+
+def buckets(days):
+    """ The bucket of each of ``days``, NaN for the calls that are still open """
+    days = np.asarray(days, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        indexes = np.ceil(np.log(days) / np.log(GAMMA))
+    indexes = np.where(days > 0, indexes, ZERO_BUCKET)
+    return np.where(np.isnan(days), np.nan, indexes).astype(np.float32)
+
+
+def value(bucket):
+    """ The value a bucket stands for, within RELATIVE_ACCURACY of all of its values """
+    bucket = np.asarray(bucket, dtype=float)
+    return np.where(bucket == ZERO_BUCKET, 0.0, 2 * GAMMA ** bucket / (GAMMA + 1))
+
+
+def quantiles(counts, qs):
+    """
+    {q: DAYS TO CLOSE quantile} of the merged sketch ``counts``, a series of
+    call counts indexed by bucket; None when it is empty
+    """
+    counts = counts[counts > 0].sort_index()
+    if not len(counts):
+        return {q: None for q in qs}
+    cumulative = np.cumsum(counts.to_numpy())
+    ranks = np.asarray(qs, dtype=float) * (cumulative[-1] - 1)
+    positions = np.searchsorted(cumulative, ranks, side='right')
+    values = value(counts.index.to_numpy()[positions])
+    return {q: float(days) for q, days in zip(qs, values)}
@@ -0,0 +1,416 @@
+"""
+Columnar snapshot of the 311 calls data.
+
+Parsing the merged 311 CSV (~1.5M rows) takes minutes, so running
+``python snapshot.py`` converts it once into a directory of ``.npy`` column
+files (string columns are dictionary encoded into integer codes plus their
+distinct values), which ``load_calls`` reads back in seconds. Columns are
+stored with the compact dtypes from ``schema``, so categoricals come back
+straight from their codes.
+
+The snapshot remembers the size and modification time of the CSV files it
+was built from, so the CSV is only parsed again when the snapshot is missing
+or stale. In that case the snapshot is rebuilt on the way out.
+
+With ``KC311_SHARED_DATA=1`` the snapshot is published once to a RAM backed
+directory (``KC311_SHARED_PATH``, /dev/shm/kc311 by default) and every
+process memory maps its columns read-only instead of loading them, so all
+gunicorn workers share one physical copy of the frame. That takes pandas 2
+(see requirements.txt): earlier versions convert the datetime columns to
+nanoseconds and consolidate the numeric ones into private copies as soon as
+the frame is used.
+"""
+import json
+import os
+import pathlib
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from schema import CATEGORICAL, EXCEPTIONS, SCHEMA_VERSION, compact, concat, read_dtypes, sort
+
+APP_PATH = str(pathlib.Path(__file__).parent.resolve())
+DATA_PATH = os.path.join(APP_PATH, "data")
+SNAPSHOT_PATH = os.path.join(DATA_PATH, "snapshot")
+
+MERGED_CSV = os.path.join(DATA_PATH, "Merged-311_Calls_2007-2020-1497400.csv")
+MERGED_SNAPSHOT = os.path.join(SNAPSHOT_PATH, "merged")
+NEIGHBORHOODS_SNAPSHOT = os.path.join(SNAPSHOT_PATH, "neighborhoods")
+
+# Bump whenever the on-disk layout changes so old snapshots are rebuilt.
+SNAPSHOT_FORMAT = 1
+MANIFEST = "manifest.json"
+
+SHARED = os.environ.get("KC311_SHARED_DATA", "0") == "1"
+SHARED_PATH = os.environ.get("KC311_SHARED_PATH", "/dev/shm/kc311")
+
+
+def neighborhood_csvs(data_path=DATA_PATH, nbhids=None):
+    """
+    The per-neighborhood partitions, e.g. data/76_neighborhood.csv, only
+    those of ``nbhids`` if given.
+    """
+    if nbhids is not None:
+        nbhids = set(int(nbhid) for nbhid in nbhids)
+    sources = []
+    for name in os.listdir(data_path):
+        match = re.match(r"^(\d+)_neighborhood\.csv$", name)
+        if match and (nbhids is None or int(match.group(1)) in nbhids):
+            sources.append(os.path.join(data_path, name))
+    return sorted(sources)
+
+
+def _source_stamps(sources):
+    stamps = []
+    for source in sources:
+        stat = os.stat(source)
+        stamps.append({"path": os.path.basename(source),
+                       "size": stat.st_size,
+                       "mtime": stat.st_mtime_ns})
+    return stamps
+
+
+def read_manifest(snapshot_dir):
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(snapshot_dir, sources):
+    """
+    A snapshot is fresh when it exists in the current format and none of its
+    sources changed since it was written. Deployments that only ship the
+    snapshot (without the CSVs) keep using it.
+    """
+    manifest = read_manifest(snapshot_dir)
+    if manifest is None or manifest.get("format") != SNAPSHOT_FORMAT:
+        return False
+    if manifest.get("schema") != SCHEMA_VERSION:
+        return False
+    existing = [source for source in sources if os.path.exists(source)]
+    if not existing:
+        return True
+    return manifest["sources"] == _source_stamps(existing)
+
+
+def _make_tmp_dir(snapshot_dir):
+    os.makedirs(os.path.dirname(snapshot_dir), exist_ok=True)
+    tmp_dir = "%s.tmp-%d" % (snapshot_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def _swap_in(tmp_dir, snapshot_dir):
+    """
+    Replace ``snapshot_dir`` with ``tmp_dir`` by renames, so readers (e.g.
+    other gunicorn workers) never see a half written directory.
+    """
+    old_dir = "%s.old-%d" % (snapshot_dir, os.getpid())
+    if os.path.exists(snapshot_dir):
+        os.rename(snapshot_dir, old_dir)
+    os.rename(tmp_dir, snapshot_dir)
+    # processes still mapping the old files keep them until they exit
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _write_manifest(tmp_dir, rows, columns, sources, extra=None):
+    manifest = {"format": SNAPSHOT_FORMAT, "schema": SCHEMA_VERSION,
+                "rows": rows, "columns": columns,
+                "sources": _source_stamps([s for s in sources if os.path.exists(s)])}
+    manifest.update(extra or {})
+    with open(os.path.join(tmp_dir, MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+
+
+def _codes_dtype(count):
+    # same width pandas uses for the codes, so they can be mapped as is
+    return np.int8 if count < 127 else np.int16 if count < 32767 else np.int32
+
+
+def write_snapshot(frame, snapshot_dir, sources=(), extra=None):
+    """
+    Write every column of ``frame`` as .npy files (``extra`` is stored in
+    the manifest). The new snapshot is assembled next to the old one and
+    swapped in once complete.
+    """
+    tmp_dir = _make_tmp_dir(snapshot_dir)
+    columns = []
+    for i, name in enumerate(frame.columns):
+        column = frame[name]
+        stem = "%03d" % i
+        if ((pd.api.types.is_numeric_dtype(column.dtype) and not pd.api.types.is_bool_dtype(column.dtype))
+                or pd.api.types.is_datetime64_dtype(column.dtype)):
+            np.save(os.path.join(tmp_dir, stem + ".npy"), column.to_numpy())
+            columns.append({"name": name, "file": stem, "kind": "numeric"})
+        else:
+            # dictionary encode, missing values get the code -1
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+            else:
+                codes, uniques = pd.factorize(column)
+            np.save(os.path.join(tmp_dir, stem + ".codes.npy"), codes.astype(_codes_dtype(len(uniques))))
+            np.save(os.path.join(tmp_dir, stem + ".values.npy"),
+                    np.asarray([str(value) for value in uniques], dtype=str))
+            columns.append({"name": name, "file": stem, "kind": "string"})
+
+    _write_manifest(tmp_dir, len(frame), columns, sources, extra)
+    _swap_in(tmp_dir, snapshot_dir)
+
+
+def reset_snapshot(snapshot_dir, sources=(), extra=None):
+    """
+    Replace ``snapshot_dir`` with an empty one stamped with ``sources``,
+    for files derived from them that are added to it one at a time
+    """
+    tmp_dir = _make_tmp_dir(snapshot_dir)
+    _write_manifest(tmp_dir, 0, [], sources, extra)
+    _swap_in(tmp_dir, snapshot_dir)
+
+
+def _string_column(snapshot_dir, column):
+    """ (codes, values) of a column, dictionary encoding it if it is numeric """
+    path = os.path.join(snapshot_dir, column["file"])
+    if column["kind"] == "string":
+        return np.load(path + ".codes.npy"), np.load(path + ".values.npy")
+    codes, uniques = pd.factorize(np.load(path + ".npy"))
+    return codes, np.asarray([str(value) for value in uniques], dtype=str)
+
+
+def stamp_snapshot(snapshot_dir, sources, extra=None):
+    """
+    Stamp ``snapshot_dir`` with ``sources`` as they are now (and update
+    its manifest with ``extra``), once what it holds was brought up to date
+    with them
+    """
+    manifest = read_manifest(snapshot_dir)
+    manifest.update({"format": SNAPSHOT_FORMAT, "schema": SCHEMA_VERSION,
+                     "sources": _source_stamps([s for s in sources if os.path.exists(s)])})
+    manifest.update(extra or {})
+    path = os.path.join(snapshot_dir, MANIFEST)
+    with open(path + ".tmp-%d" % os.getpid(), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(path + ".tmp-%d" % os.getpid(), path)
+
+
+def merge_snapshots(pieces, snapshot_dir, sources=(), extra=None):
+    """
+    Concatenate snapshots with the same columns into one, straight from their
+    .npy files: string columns are recoded against the union of their values
+    and never go through pandas. A piece is a snapshot directory, or a
+    (directory, start, end) slice of its rows.
+    """
+    pieces = [(piece, 0, None) if isinstance(piece, str) else tuple(piece) for piece in pieces]
+    snapshot_dirs = list(dict.fromkeys(path for path, _, _ in pieces))
+    manifests = {path: read_manifest(path) for path in snapshot_dirs}
+    tmp_dir = _make_tmp_dir(snapshot_dir)
+    columns = []
+    for i, name in enumerate(column["name"] for column in manifests[snapshot_dirs[0]]["columns"]):
+        parts = {path: next(column for column in manifest["columns"] if column["name"] == name)
+                 for path, manifest in manifests.items()}
+        stem = "%03d" % i
+        if all(column["kind"] == "numeric" for column in parts.values()):
+            arrays = {path: np.load(os.path.join(path, column["file"] + ".npy"), mmap_mode="r")
+                      for path, column in parts.items()}
+            dtype = np.result_type(*arrays.values())
+            floats = [array.dtype for array in arrays.values() if array.dtype.kind == 'f']
+            if floats and dtype.kind == 'f':
+                # an integer column stored as float32 in some parts stays float32
+                dtype = max(floats)
+            np.save(os.path.join(tmp_dir, stem + ".npy"),
+                    np.concatenate([arrays[path][start:end].astype(dtype, copy=False)
+                                    for path, start, end in pieces]))
+            columns.append({"name": name, "file": stem, "kind": "numeric"})
+        else:
+            encoded = {path: _string_column(path, column) for path, column in parts.items()}
+            values, inverse = np.unique(np.concatenate([part_values for _, part_values in encoded.values()]),
+                                        return_inverse=True)
+            recodes, offset = {}, 0
+            for path, (_, part_values) in encoded.items():
+                # the trailing -1 is what code -1 picks up
+                recodes[path] = np.append(inverse[offset:offset + len(part_values)], -1)
+                offset += len(part_values)
+            codes = [recodes[path][encoded[path][0][start:end]] for path, start, end in pieces]
+            np.save(os.path.join(tmp_dir, stem + ".codes.npy"),
+                    np.concatenate(codes).astype(_codes_dtype(len(values))))
+            np.save(os.path.join(tmp_dir, stem + ".values.npy"), values)
+            columns.append({"name": name, "file": stem, "kind": "string"})
+
+    rows = sum((manifests[path]["rows"] if end is None else end) - start for path, start, end in pieces)
+    _write_manifest(tmp_dir, rows, columns, sources, extra)
+    _swap_in(tmp_dir, snapshot_dir)
+
+
+def read_snapshot(snapshot_dir, usecols=None, mmap=False):
+    """
+    Read the columns of a snapshot. With ``mmap`` the numeric columns and
+    the string codes stay read-only memory maps of the .npy files (every
+    string column then comes back as a categorical, so nothing is copied
+    but the distinct values). The frame keeps one block per column, which
+    pandas 2 leaves as it is.
+    """
+    mmap_mode = "r" if mmap else None
+    manifest = read_manifest(snapshot_dir)
+    data = {}
+    for column in manifest["columns"]:
+        name = column["name"]
+        if usecols is not None and name not in usecols:
+            continue
+        path = os.path.join(snapshot_dir, column["file"])
+        if column["kind"] == "numeric":
+            data[name] = np.load(path + ".npy", mmap_mode=mmap_mode)
+        else:
+            codes = np.load(path + ".codes.npy", mmap_mode=mmap_mode)
+            values = np.load(path + ".values.npy").astype(object)
+            if mmap or name in CATEGORICAL:
+                data[name] = pd.Categorical.from_codes(codes, categories=values)
+            else:
+                # the extra trailing NaN is what code -1 picks up
+                data[name] = np.append(values, np.nan)[codes]
+    return pd.DataFrame(data, columns=list(data), copy=False)
+
+
+def publish(sources, snapshot_dir):
+    """
+    Make sure a fresh copy of the snapshot sits in SHARED_PATH and return
+    its path. Run by the gunicorn master before forking (see
+    gunicorn.conf.py); a worker only publishes when it finds no fresh copy.
+    """
+    if not os.path.isdir(os.path.dirname(SHARED_PATH)):
+        # no RAM backed filesystem, the page cache of the snapshot is shared too
+        load_calls(sources, snapshot_dir, shared=False)
+        return snapshot_dir
+    shared_dir = os.path.join(SHARED_PATH, os.path.basename(snapshot_dir))
+    if is_fresh(shared_dir, sources):
+        return shared_dir
+    if not is_fresh(snapshot_dir, sources):
+        load_calls(sources, snapshot_dir, shared=False)
+    tmp_dir = _make_tmp_dir(shared_dir)
+    os.rmdir(tmp_dir)
+    shutil.copytree(snapshot_dir, tmp_dir)
+    _swap_in(tmp_dir, shared_dir)
+    print("published snapshot %s to %s" % (snapshot_dir, shared_dir))
+    return shared_dir
+
+
+def read_csv(source, usecols=None):
+    """ One CSV file, parsed straight into the schema dtypes """
+    columns = pd.read_csv(source, nrows=0).columns
+    if usecols is not None:
+        # a virtual column is read to get its exceptions
+        columns = [col for col in columns if col in usecols or EXCEPTIONS % col in usecols]
+    return compact(pd.read_csv(source, usecols=columns, dtype=read_dtypes(columns)),
+                   name=os.path.basename(source))
+
+
+def read_csvs(sources, usecols=None):
+    """
+    Parse ``sources`` (one process per file when there are several) and
+    concatenate the compacted frames.
+    """
+    if len(sources) == 1:
+        return read_csv(sources[0], usecols)
+    with ProcessPoolExecutor(max_workers=min(len(sources), os.cpu_count() or 1)) as pool:
+        frames = list(pool.map(read_csv, sources, [usecols] * len(sources)))
+    return concat(frames)
+
+
+def load_calls(sources, snapshot_dir, usecols=None, shared=SHARED):
+    """
+    Load the 311 calls from ``snapshot_dir``, falling back to parsing the
+    ``sources`` CSV files (and rebuilding the snapshot) when it is missing
+    or stale. In shared mode the frame is memory mapped from the published
+    copy instead.
+    """
+    start = time.time()
+    if shared:
+        shared_dir = publish(sources, snapshot_dir)
+        frame = read_snapshot(shared_dir, usecols, mmap=True)
+        print("mapped %d rows from %s in %.1fs" % (len(frame), shared_dir, time.time() - start))
+        return frame
+    if is_fresh(snapshot_dir, sources):
+        frame = read_snapshot(snapshot_dir, usecols)
+        print("loaded %d rows from snapshot %s in %.1fs" % (len(frame), snapshot_dir, time.time() - start))
+        return frame
+
+    frame = sort(read_csvs(sources))
+    print("parsed %d rows from %d csv file(s) in %.1fs" % (len(frame), len(sources), time.time() - start))
+    try:
+        write_snapshot(frame, snapshot_dir, sources)
+    except OSError as e:
+        # a read-only deploy can still serve from the CSV
+        print("could not write snapshot %s: %s" % (snapshot_dir, e))
+    if usecols is not None:
+        frame = frame[[col for col in frame.columns if col in usecols]]
+    return frame
+
+
+def load_merged_calls(usecols=None, use_store=True):
+    """
+    The merged 2007-2020 dataset used by app.py and compare_app.py, or the
+    partitioned store it was seeded into once there is one (see store.py).
+    """
+    if use_store:
+        import store  # store builds on this module
+        if store.exists():
+            return store.load(usecols)
+    return load_calls([MERGED_CSV], MERGED_SNAPSHOT, usecols)
+
+
+def merged_manifest(use_store=True):
+    """
+    Manifest of the snapshot load_merged_calls reads, the source to stamp
+    what is built from the merged calls with (see cube.py).
+    """
+    if use_store:
+        import store
+        if store.exists():
+            return os.path.join(store.merged_path(), MANIFEST)
+    return os.path.join(MERGED_SNAPSHOT, MANIFEST)
+
+
+def load_neighborhood_calls(usecols=None, nbhids=None):
+    """
+    The per-neighborhood CSV files used by the dl_app scripts. With
+    ``nbhids`` only those neighborhoods are loaded: from the snapshot when it
+    is fresh, otherwise only their CSV files are parsed.
+    """
+    sources = neighborhood_csvs()
+    if nbhids is None:
+        return load_calls(sources, NEIGHBORHOODS_SNAPSHOT, usecols)
+    start = time.time()
+    nbhids = [int(nbhid) for nbhid in nbhids]
+    if is_fresh(NEIGHBORHOODS_SNAPSHOT, sources):
+        cols = None if usecols is None else list(usecols) + ['nbh_id']
+        frame = read_snapshot(NEIGHBORHOODS_SNAPSHOT, cols)
+        frame = frame[frame['nbh_id'].isin(nbhids).to_numpy()].reset_index(drop=True)
+        if usecols is not None and 'nbh_id' not in usecols:
+            frame = frame.drop(columns='nbh_id')
+    else:
+        frame = read_csvs(neighborhood_csvs(nbhids=nbhids), usecols)
+    print("loaded %d rows of %d neighborhood(s) in %.1fs" % (len(frame), len(nbhids), time.time() - start))
+    return frame
+
+
+def build(sources, snapshot_dir):
+    start = time.time()
+    frame = sort(read_csvs(sources))
+    write_snapshot(frame, snapshot_dir, sources)
+    print("wrote %d rows x %d columns to %s in %.1fs"
+          % (len(frame), len(frame.columns), snapshot_dir, time.time() - start))
+
+
+if __name__ == "__main__":
+    # python snapshot.py               -> merged dataset
+    # python snapshot.py neighborhoods -> data/*_neighborhood.csv
+    if sys.argv[1:] == ["neighborhoods"]:
+        build(neighborhood_csvs(), NEIGHBORHOODS_SNAPSHOT)
+    else:
+        build([MERGED_CSV], MERGED_SNAPSHOT)
@@ -0,0 +1,189 @@
+"""
+Embedded SQL backend for the chart aggregates.
+
+With ``KC311_QUERY_ENGINE=sqlite`` (or ``duckdb``, when it is installed)
+the chart callbacks run their filters and group-bys as SQL against an
+in-process database instead of summing the pandas cube (the default,
+``pandas``, see cube.py). The database holds one row per call with the cube
+dimensions and measures, loaded from the calls snapshot when the app
+starts, and ``query`` takes the same arguments and returns the same series
+as cube.query. Every thread queries through its own connection to the
+database, so callbacks do not wait for each other, and the statement of
+each chart is parameterized, so it is only prepared once per connection
+(sqlite3 and duckdb keep the prepared ones).
+
+    python sqlengine.py               # compare the engines on the merged dataset
+    python sqlengine.py neighborhoods # or on data/*_neighborhood.csv
+"""
+import itertools
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import cube
+
+ENGINE = os.environ.get("KC311_QUERY_ENGINE", "pandas")
+ENGINES = ['sqlite', 'duckdb']
+TABLE = "calls"
+# numbers the in-memory sqlite databases, which are shared by name
+_databases = itertools.count()
+
+
+def _quote(name):
+    return '"%s"' % name
+
+
+def connect(frame, engine=ENGINE):
+    """ An in-memory ``engine`` database with the calls of ``frame`` """
+    start = time.time()
+    facts = cube.facts(frame)
+    for dim in cube.DIMENSIONS:
+        if isinstance(facts[dim].dtype, pd.CategoricalDtype) or facts[dim].dtype.kind == 'f':
+            # plain values and NULL, categoricals are not SQL types and NaN is not NULL
+            facts[dim] = facts[dim].astype(object).where(facts[dim].notna(), None)
+    uri = None
+    if engine == 'sqlite':
+        # a named in-memory database, the connections of the other threads open it too
+        uri = "file:%s%d?mode=memory&cache=shared" % (TABLE, next(_databases))
+        connection = sqlite3.connect(uri, uri=True)
+        columns = ", ".join(_quote(col) for col in facts.columns)
+        connection.execute("CREATE TABLE %s (%s)" % (TABLE, columns))
+        rows = zip(*[facts[col].tolist() for col in facts.columns])
+        with connection:  # committed, the other connections cannot read it before
+            connection.executemany("INSERT INTO %s VALUES (%s)" % (TABLE, ", ".join("?" * len(facts.columns))),
+                                   rows)
+    elif engine == 'duckdb':
+        import duckdb  # optional dependency
+        connection = duckdb.connect(":memory:")
+        connection.register("facts", facts)
+        connection.execute("CREATE TABLE %s AS SELECT * FROM facts" % TABLE)
+        connection.unregister("facts")
+    else:
+        raise ValueError("unknown query engine %r" % engine)
+    connection.execute("CREATE INDEX calls_selection ON %s (%s)"
+                       % (TABLE, ", ".join(_quote(dim) for dim in cube.DIMENSIONS[:3])))
+    print("loaded %d rows into %s in %.1fs" % (len(facts), engine, time.time() - start))
+    # the database lives as long as this connection, the one of the loading thread
+    return {'engine': engine, 'connection': connection, 'uri': uri, 'threads': threading.local()}
+
+
+def _connection(database):
+    """ The connection of the calling thread to ``database``, opened by its first query """
+    threads = database['threads']
+    if not hasattr(threads, 'connection'):
+        if database['engine'] == 'sqlite':
+            threads.connection = sqlite3.connect(database['uri'], uri=True)
+        else:
+            threads.connection = database['connection'].cursor()
+    return threads.connection
+
+
+def is_database(calls_cube):
+    return 'connection' in calls_cube
+
+
+def _statement(by, measures, nbd_count, years, months, filter_counts):
+    """ The SQL of a query, with one ? per parameter """
+    selected = [_quote(dim) for dim in by] + ["SUM(%s)" % _quote(measure) for measure in measures]
+    where = ["%s IS NOT NULL" % _quote(dim) for dim in by]
+    if nbd_count is not None:
+        where.append("nbhid IN (%s)" % ", ".join("?" * nbd_count) if nbd_count else "FALSE")
+    for dim, count in filter_counts:
+        where.append("%s IN (%s)" % (_quote(dim), ", ".join("?" * count)) if count else "FALSE")
+    if years:
+        where.append('"CREATION YEAR" BETWEEN ? AND ?')
+    if months:
+        where.append('"CREATION MONTH" BETWEEN ? AND ?')
+    sql = "SELECT %s FROM %s" % (", ".join(selected), TABLE)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if by:
+        grouped = ", ".join(_quote(dim) for dim in by)
+        sql += " GROUP BY %s ORDER BY %s" % (grouped, grouped)
+    return sql
+
+
+def _param(value):
+    # numpy scalars are not SQL parameters
+    return value.item() if hasattr(value, 'item') else value
+
+
+def query(database, by, nbds=None, years_range=None, months_range=None, measures='count', filters=None):
+    """ cube.query, in SQL """
+    by = list(by)
+    names = [measures] if isinstance(measures, str) else list(measures)
+    filters = [(dim, list(values)) for dim, values in (filters or {}).items()]
+    sql = _statement(by, names, None if nbds is None else len(nbds),
+                     years_range is not None, months_range is not None,
+                     [(dim, len(values)) for dim, values in filters])
+    params = [int(nbd) for nbd in nbds or []]
+    for dim, values in filters:
+        params.extend(_param(value) for value in values)
+    for value_range in (years_range, months_range):
+        if value_range is not None:
+            params.extend(int(value) for value in value_range)
+    rows = _connection(database).execute(sql, params).fetchall()
+    result = pd.DataFrame(rows, columns=by + names)
+    result[names] = result[names].fillna(0)
+    if not by:
+        sums = result[names].iloc[0] if len(result) else pd.Series(0, index=names)
+        return sums[measures]
+    result = result.set_index(by)
+    return result[measures]
+
+
+def _compare(source):
+    """
+    Time the chart queries on every engine and check they agree with the
+    cube, returns whether they all do
+    """
+    import dataset  # needs the app dependencies
+
+    frame = dataset.load(source)
+    calls_cube = cube.build(frame)
+    nbds = [int(nbd) for nbd in frame['nbhid'].unique()[:4]]
+    departments = list(frame['DEPARTMENT'].dropna().unique()[:2])
+    charts = [(['CREATION YEAR'], nbds, [2007, 2020], [1, 12]),
+              (['DEPARTMENT', 'CREATION YEAR'], nbds, [2012, 2020], [3, 9]),
+              (['CATEGORY', 'CREATION YEAR'], nbds, [2007, 2020], [1, 12]),
+              (['hour'], nbds, [2015, 2020], None),
+              (['nbhid'], None, [2010, 2015], None),
+              (['days_bucket'], nbds, None, None, 'count', {'DEPARTMENT': departments}),
+              ([], None, None, None, ['count', 'days_sum', 'days_count', 'exceeded']),
+              (['CREATION YEAR'], nbds, None, None, 'count', {'DEPARTMENT': []})]
+    engines = [('pandas', calls_cube)]
+    for engine in ENGINES:
+        try:
+            engines.append((engine, connect(frame, engine)))
+        except ImportError as e:
+            print("skipping %s: %s" % (engine, e))
+    expected = [cube.query(calls_cube, *chart) for chart in charts]
+    agree = True
+    for engine, calls in engines:
+        start = time.time()
+        for chart, reference in zip(charts, expected):
+            result = dataset.aggregate(calls, *chart)
+            if not _same(result, reference):
+                print("%s disagrees with the cube on %s" % (engine, ", ".join(chart[0]) or "the totals"))
+                agree = False
+        print("%s: %.1f ms per chart" % (engine, (time.time() - start) * 1000 / len(charts)))
+    return agree
+
+
+def _same(result, reference):
+    """ Whether two query results hold the same values, up to float rounding """
+    if isinstance(reference, pd.DataFrame):
+        result, reference = result.stack(), reference.stack()
+    if not isinstance(reference, pd.Series):
+        return abs(result - reference) <= 1e-9 * max(1, abs(reference))
+    result, reference = result.to_dict(), reference.to_dict()
+    return result.keys() == reference.keys() and all(
+        abs(result[key] - reference[key]) <= 1e-9 * max(1, abs(reference[key])) for key in reference)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if _compare(sys.argv[1] if sys.argv[1:] else "merged") else 1)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import bitmap
+
+# none but the last a multiple of 64, the last word of a bitmap is then partly past the rows
+ROWS = [130, 1000, 4096]
+
+
+def masks(rows, seed=11):
+    """ Random row masks, from sparse to almost full, and an empty one """
+    rng = np.random.default_rng(seed + rows)
+    return [rng.random(rows) < density for density in (0.01, 0.3, 0.97)] + [np.zeros(rows, dtype=bool)]
+
+
+def of(mask):
+    return bitmap.from_positions(np.flatnonzero(mask))
+
+
+def rows_of(value):
+    return bitmap.positions(value).tolist()
+
+
+@pytest.mark.parametrize("rows", ROWS)
+def test_operations_agree_with_boolean_masks(rows):
+    for a in masks(rows):
+        assert rows_of(of(a)) == np.flatnonzero(a).tolist()
+        assert bitmap.cardinality(of(a)) == a.sum()
+        # NOT, within the rows
+        assert rows_of(bitmap.andnot(bitmap.full(rows), of(a))) == np.flatnonzero(~a).tolist()
+        for b in masks(rows, seed=5):
+            assert rows_of(bitmap.and_(of(a), of(b))) == np.flatnonzero(a & b).tolist()
+            assert rows_of(bitmap.or_(of(a), of(b))) == np.flatnonzero(a | b).tolist()
+            assert rows_of(bitmap.andnot(of(a), of(b))) == np.flatnonzero(a & ~b).tolist()
+            assert bitmap.cardinality(bitmap.and_(of(a), of(b))) == (a & b).sum()
+
+
+@pytest.mark.parametrize("rows", ROWS)
+def test_full_and_ranges_stop_at_the_last_row(rows):
+    assert rows_of(bitmap.full(rows)) == list(range(rows))
+    assert bitmap.cardinality(bitmap.full(rows)) == rows
+    starts, ends = np.array([0, 3, 63, 64, rows - 2]), np.array([2, 3, 65, 100, rows])
+    mask = np.zeros(rows, dtype=bool)
+    for start, end in zip(starts, ends):
+        mask[start:end] = True
+    assert rows_of(bitmap.from_ranges(starts, ends)) == np.flatnonzero(mask).tolist()
+
+
+def test_match_agrees_with_isin():
+    rng = np.random.default_rng(3)
+    frame = pd.DataFrame({'STATUS': pd.Categorical(rng.choice(['OPEN', 'RESOL'], 1000)),
+                          'SOURCE': rng.choice(['PHONE', 'WEB', 'EMAIL'], 1000)})
+    index = bitmap.build(frame)
+    filters = {'STATUS': ['OPEN'], 'SOURCE': ['WEB', 'EMAIL', 'FAX']}
+    mask = frame['STATUS'].isin(['OPEN']).to_numpy() & frame['SOURCE'].isin(filters['SOURCE']).to_numpy()
+    assert rows_of(bitmap.match(index, filters)) == np.flatnonzero(mask).tolist()
+    assert rows_of(bitmap.match(index, {})) == list(range(1000))
+    assert rows_of(bitmap.match(index, {'SOURCE': []})) == []
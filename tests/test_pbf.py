@@ -0,0 +1,73 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import pbf
+
+geobuf = pytest.importorskip("geobuf")
+
+
+def reference(lat, lon, properties):
+    """ What geobuf.encode makes of the same points as GeoJSON, missing strings as NaN """
+    features = []
+    for i in range(len(lat)):
+        values = {}
+        for key, column in properties:
+            value = column[i]
+            if value is None:
+                value = float('nan')
+            values[key] = value if isinstance(value, str) else float(value)
+        features.append({'type': 'Feature', 'properties': values,
+                         'geometry': {'type': 'Point', 'coordinates': [float(lon[i]), float(lat[i])]}})
+    return geobuf.encode({'type': 'FeatureCollection', 'features': features}, 6, 2)
+
+
+@pytest.fixture(scope="module")
+def calls():
+    rng = np.random.default_rng(1)
+    rows = 2000
+    days = np.where(rng.random(rows) < 0.2, np.nan, rng.integers(0, 10 ** 6, rows).astype(float))
+    # fractions, negatives (zero too) and integers past 32 bits
+    days[::7] += 0.25
+    days[3], days[4], days[5], days[6] = -0.0, -3.5, 2.0 ** 40, -17
+    names = np.array(["Crown Center", "Westport", "é" * 70, None], dtype=object)[rng.integers(0, 4, rows)]
+    return {'lat': rng.uniform(38.8, 39.4, rows), 'lon': rng.uniform(-94.8, -94.3, rows), 'days': days, 'names': names}
+
+
+def test_numbers_and_strings_encode_as_geobuf_does(calls):
+    properties = [('NEIGHBORHOOD', pd.Series(calls['names'])), ('DAYS TO CLOSE', calls['days'])]
+    expected = reference(calls['lat'], calls['lon'], [(key, list(values)) for key, values in properties])
+    assert pbf.points(calls['lat'], calls['lon'], properties) == expected
+
+
+def test_categoricals_and_integer_columns_encode_as_their_values(calls):
+    counts = (np.arange(len(calls['lat'])) * 37 % 500 - 250).astype(np.int32)
+    properties = [('NEIGHBORHOOD', pd.Series(calls['names']).astype('category')), ('point_count', counts)]
+    expected = reference(calls['lat'], calls['lon'], [('NEIGHBORHOOD', list(calls['names'])),
+                                                      ('point_count', counts.tolist())])
+    assert pbf.points(calls['lat'], calls['lon'], properties) == expected
+
+
+def test_features_join_into_one_collection(calls):
+    properties = [('DAYS TO CLOSE', calls['days'])]
+    parts = [pbf.features(calls['lat'][start:start + 500], calls['lon'][start:start + 500],
+                          [calls['days'][start:start + 500]]) for start in range(0, len(calls['lat']), 500)]
+    assert pbf.join(['DAYS TO CLOSE'], parts) == pbf.points(calls['lat'], calls['lon'], properties)
+
+
+def test_no_points_decode_to_an_empty_collection():
+    data = pbf.points(np.zeros(0), np.zeros(0), [('NEIGHBORHOOD', pd.Series([], dtype='category')),
+                                                 ('DAYS TO CLOSE', np.zeros(0))])
+    assert geobuf.decode(data) == {'type': 'FeatureCollection', 'features': []}
+
+
+def test_missing_values_decode_as_nan(calls):
+    data = pbf.points(calls['lat'][:4], calls['lon'][:4],
+                      [('NEIGHBORHOOD', pd.Series([None, 'Westport', None, 'Westport'])),
+                       ('DAYS TO CLOSE', np.array([np.nan, 1.0, 2.5, np.nan]))])
+    decoded = [feature['properties'] for feature in geobuf.decode(data)['features']]
+    assert [math.isnan(values['NEIGHBORHOOD']) for values in decoded if values['NEIGHBORHOOD'] != 'Westport'] == [True, True]
+    assert [values['DAYS TO CLOSE'] for values in decoded][1:3] == [1, 2.5]
+    assert math.isnan(decoded[0]['DAYS TO CLOSE']) and math.isnan(decoded[3]['DAYS TO CLOSE'])
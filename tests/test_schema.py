@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from schema import EXCEPTIONS, VIRTUAL, compact, concat, materialize
+from snapshot import read_snapshot, write_snapshot
+
+
+def calls(case_ids, statuses, closed_dates, closed_months, addresses=None):
+    """ Source rows of the merged CSV with the virtual columns as the city writes them """
+    rows = len(case_ids)
+    frame = pd.DataFrame({
+        'CASE ID': case_ids,
+        'STATUS': statuses,
+        'CLOSED DATE': closed_dates,
+        'CLOSED MONTH': closed_months,
+        'CLOSED YEAR': [np.nan if status == 'CANC' or date is None else float(date[-4:])
+                        for status, date in zip(statuses, closed_dates)],
+        'STREET ADDRESS': ['%d MAIN ST' % (100 + i) for i in range(rows)],
+        'ZIP CODE': [64111.0] * rows,
+        'LATITUDE': [39.05361 + i / 1000 for i in range(rows)],
+        'LONGITUDE': [-94.5926] * rows,
+    })
+    frame['CASE URL'] = ["http://city.kcmo.org/kc/ActionCenterRequest/CaseInfo.aspx?CaseID=%d" % case_id
+                         for case_id in case_ids]
+    frame['ADDRESS WITH GEOCODE'] = addresses or [
+        "%s64111\n(%s, -94.5926)" % (address, ("%.6f" % lat).rstrip('0'))
+        for address, lat in zip(frame['STREET ADDRESS'], frame['LATITUDE'])]
+    return frame
+
+
+def test_exceptions_are_stored_whether_or_not_a_frame_has_any(tmp_path):
+    plain = calls([1, 2], ['RESOL', 'CANC'], ['03/02/2019', '04/05/2019'], [3.0, np.nan])
+    # a month given to a cancelled case, and an address the rule cannot rebuild
+    odd = calls([3, 4], ['CANC', 'RESOL'], ['05/06/2020', None], [5.0, np.nan],
+                addresses=["1 ELM ST\nKansas City", None])
+    frames = [compact(plain.copy()), compact(odd.copy())]
+    for frame in frames:
+        assert not set(VIRTUAL) & set(frame.columns)
+        assert all(EXCEPTIONS % name in frame.columns for name in VIRTUAL)
+    assert list(frames[0].columns) == list(frames[1].columns)
+    assert frames[0][EXCEPTIONS % 'CLOSED MONTH'].isna().all()
+
+    merged = concat(frames)
+    write_snapshot(merged, str(tmp_path / "calls"))
+    exported = materialize(read_snapshot(str(tmp_path / "calls")))
+    expected = pd.concat([plain, odd], ignore_index=True)
+    for name in VIRTUAL:
+        pd.testing.assert_series_equal(exported[name].astype(expected[name].dtype), expected[name],
+                                       check_names=False, check_dtype=False)
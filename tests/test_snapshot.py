@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from snapshot import read_snapshot, write_snapshot
+
+
+def is_mapped(column):
+    array = column.array.codes if isinstance(column.dtype, pd.CategoricalDtype) else column.to_numpy()
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def test_mapped_columns_stay_mapped_while_the_frame_is_used(tmp_path):
+    rows = 1000
+    frame = pd.DataFrame({
+        'CASE ID': np.arange(rows, dtype=np.int64),
+        'nbh_id': (np.arange(rows) % 7).astype(np.int16),
+        'CREATION YEAR': (2010 + np.arange(rows) % 5).astype(np.int16),
+        'DAYS TO CLOSE': np.linspace(0, 50, rows, dtype=np.float32),
+        'LATITUDE': np.linspace(39.0, 39.2, rows),
+        'created_ts': pd.date_range("2019-01-01", periods=rows, freq="h").astype('datetime64[us]'),
+        'STATUS': np.where(np.arange(rows) % 3, 'RESOL', 'OPEN'),
+    })
+    write_snapshot(frame, str(tmp_path / "calls"))
+    mapped = read_snapshot(str(tmp_path / "calls"), mmap=True)
+    mapped.rename(columns={'nbh_id': 'nbhid'}, inplace=True)
+    # what the apps do with the frame, pandas before 2 consolidated the columns into copies here
+    mapped.groupby(['nbhid', 'CREATION YEAR'], observed=True)['DAYS TO CLOSE'].sum()
+    mapped.select_dtypes('number').sum()
+    mapped.take(np.arange(10))
+    assert [name for name in mapped.columns if not is_mapped(mapped[name])] == []
+    assert mapped.drop(columns='STATUS').equals(frame.rename(columns={'nbh_id': 'nbhid'}).drop(columns='STATUS'))
@@ -0,0 +1,90 @@
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cube
+import sqlengine
+
+
+def calls(rows=400, seed=7):
+    """ Calls with the columns of the cube, some of them open or without a department """
+    rng = np.random.default_rng(seed)
+    days = rng.exponential(20, rows).astype(np.float32)
+    days[rng.random(rows) < 0.2] = np.nan
+    departments = np.array(['Water Services', 'Public Works', 'Parks', None], dtype=object)
+    return pd.DataFrame({
+        'nbhid': rng.choice([3, 5, 52, 78], rows).astype(np.int16),
+        'CREATION YEAR': rng.integers(2015, 2021, rows).astype(np.int16),
+        'CREATION MONTH': rng.integers(1, 13, rows).astype(np.int8),
+        'DEPARTMENT': pd.Categorical(rng.choice(departments, rows)),
+        'CATEGORY': pd.Categorical(rng.choice(['Trash', 'Streets', 'Water'], rows)),
+        'hour': rng.integers(0, 24, rows).astype(np.int8),
+        'DAYS TO CLOSE': days,
+        'EXCEEDED EST TIMEFRAME': pd.Categorical(rng.choice(['Y', 'N'], rows)),
+    })
+
+
+@pytest.fixture(scope="module")
+def frame():
+    return calls()
+
+
+@pytest.fixture(scope="module")
+def calls_cube(frame):
+    return cube.build(frame)
+
+
+@pytest.fixture(scope="module")
+def database(frame):
+    return sqlengine.connect(frame, 'sqlite')
+
+
+QUERIES = [
+    dict(by=['CREATION YEAR'], nbds=[3, 52], years_range=[2016, 2019], months_range=[3, 9]),
+    dict(by=['DEPARTMENT', 'CREATION YEAR'], nbds=[5, 78]),
+    dict(by=['CATEGORY'], years_range=[2015, 2017], measures=['count', 'days_sum', 'days_count']),
+    dict(by=['hour'], nbds=[78], measures='exceeded'),
+    dict(by=['nbhid'], months_range=[12, 12]),
+    dict(by=['days_bucket'], nbds=[3, 5]),
+    dict(by=['CREATION YEAR'], filters={'DEPARTMENT': ['Parks', 'Public Works']}),
+    dict(by=['CATEGORY'], nbds=[52], months_range=[2, 11], filters={'CATEGORY': ['Trash', 'Water']}),
+    dict(by=['CREATION MONTH'], filters={'days_bucket': [0, 1, 2]}),
+    dict(by=['nbhid'], filters={'DEPARTMENT': []}),
+    dict(by=['hour'], nbds=[]),
+    dict(by=['CREATION YEAR'], years_range=[2030, 2031]),
+    dict(by=[]),
+    dict(by=[], measures=['count', 'days_sum', 'days_count', 'exceeded']),
+    dict(by=[], nbds=[5], filters={'DEPARTMENT': ['Water Services']}, measures='days_sum'),
+    dict(by=[], filters={'CATEGORY': []}),
+]
+
+
+def as_dict(result):
+    """ {group (and measure): value} of a query result, or its value """
+    if isinstance(result, pd.DataFrame):
+        result = result.stack()
+    return result.to_dict() if isinstance(result, pd.Series) else result
+
+
+@pytest.mark.parametrize("query", QUERIES, ids=lambda query: ",".join("%s=%s" % item for item in query.items()))
+def test_sql_agrees_with_the_cube(calls_cube, database, query):
+    expected = cube.query(calls_cube, **query)
+    assert as_dict(sqlengine.query(database, **query)) == pytest.approx(as_dict(expected))
+
+
+def test_threads_query_through_their_own_connections(calls_cube, database):
+    query = QUERIES[1]
+    results = [None] * 4
+
+    def run(index):
+        results[index] = as_dict(sqlengine.query(database, **query))
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = as_dict(cube.query(calls_cube, **query))
+    assert all(result == pytest.approx(expected) for result in results)
@@ -0,0 +1,100 @@
+import os
+
+import pandas as pd
+
+import store
+from schema import CASE_URL_PREFIX, SOURCE_COLUMNS, concat
+from snapshot import read_snapshot
+
+
+def extract(path, cases):
+    """ A CSV extract in the layout of the merged CSV, one row per (CASE ID, year, nbh_id, status) """
+    rows = []
+    for case_id, year, nbhid, status in cases:
+        closed = status == 'RESOL'
+        rows.append({
+            'CASE ID': case_id, 'SOURCE': 'PHONE', 'DEPARTMENT': 'Public Works', 'WORK GROUP': 'Streets',
+            'REQUEST TYPE': 'Streets-Pothole', 'CATEGORY': 'Streets', 'TYPE': 'Pothole', 'DETAIL': 'Pothole',
+            'CREATION DATE': '03/04/%d' % year, 'CREATION TIME': '09:15 AM', 'CREATION MONTH': 3,
+            'CREATION YEAR': year, 'STATUS': status, 'EXCEEDED EST TIMEFRAME': 'N',
+            'CLOSED DATE': '03/10/%d' % year if closed else None, 'CLOSED MONTH': 3.0 if closed else None,
+            'CLOSED YEAR': float(year) if closed else None, 'DAYS TO CLOSE': 6.0 if closed else None,
+            'STREET ADDRESS': '938 Mulberry St', 'ADDRESS WITH GEOCODE': '938 Mulberry St64101\n(39.102738, -94.600134)',
+            'ZIP CODE': 64101.0, 'NEIGHBORHOOD': 'Nbh %d' % nbhid, 'COUNTY': 'Jackson', 'COUNCIL DISTRICT': 4.0,
+            'POLICE DISTRICT': 'Central', 'PARCEL ID NO': 123162, 'LATITUDE': 39.102738, 'LONGITUDE': -94.600134,
+            'CASE URL': CASE_URL_PREFIX + str(case_id), '30-60-90 Days Open Window': None,
+            'nbh_id': nbhid, 'nbh_name': 'Nbh %d' % nbhid,
+        })
+    pd.DataFrame(rows, columns=SOURCE_COLUMNS).to_csv(path, index=False)
+    return str(path)
+
+
+def stored(store_path):
+    """ {(year, nbhid): sorted CASE IDs} of the partitions of the store """
+    return {part: sorted(read_snapshot(path, ['CASE ID'])['CASE ID'].tolist())
+            for part, path in store.partitions(store_path).items()}
+
+
+def merged(store_path):
+    return read_snapshot(store.merge(store_path))
+
+
+def test_a_closed_case_replaces_its_open_row(tmp_path):
+    store_path = str(tmp_path / "store")
+    store.ingest(extract(tmp_path / "first.csv", [(1, 2019, 3, 'OPEN'), (2, 2019, 3, 'OPEN'),
+                                                  (3, 2020, 5, 'RESOL')]), store_path)
+    store.ingest(extract(tmp_path / "delta.csv", [(1, 2019, 3, 'RESOL')]), store_path)
+    assert stored(store_path) == {(2019, 3): [1, 2], (2020, 5): [3]}
+    calls = merged(store_path).set_index('CASE ID')
+    assert calls.loc[1, 'STATUS'] == 'RESOL' and calls.loc[1, 'DAYS TO CLOSE'] == 6.0
+    assert calls.loc[2, 'STATUS'] == 'OPEN'
+
+
+def test_a_case_moved_to_another_partition_is_only_kept_there(tmp_path):
+    store_path = str(tmp_path / "store")
+    store.ingest(extract(tmp_path / "first.csv", [(1, 2019, 3, 'OPEN'), (2, 2019, 5, 'OPEN'),
+                                                  (3, 2019, 5, 'OPEN'), (4, 2020, 7, 'OPEN')]), store_path)
+    # case 2 moves to another neighborhood, case 4 to another year (emptying its partition)
+    store.ingest(extract(tmp_path / "delta.csv", [(2, 2019, 3, 'RESOL'), (4, 2018, 7, 'OPEN')]), store_path)
+    assert stored(store_path) == {(2018, 7): [4], (2019, 3): [1, 2], (2019, 5): [3]}
+    assert not os.path.exists(store.partition_path(2020, 7, store_path))
+    calls = merged(store_path)
+    assert sorted(calls['CASE ID'].tolist()) == [1, 2, 3, 4]
+    assert calls.set_index('CASE ID').loc[2, 'nbh_id'] == 3
+
+
+def test_merge_only_reads_the_changed_partitions_again(tmp_path, monkeypatch):
+    store_path = str(tmp_path / "store")
+    store.ingest(extract(tmp_path / "first.csv", [(case, 2010 + case % 4, case % 3, 'OPEN')
+                                                  for case in range(1, 40)]), store_path)
+    merges = []
+    merge_snapshots = store.merge_snapshots
+    monkeypatch.setattr(store, "merge_snapshots",
+                        lambda pieces, *args, **kwargs: merges.append(pieces) or merge_snapshots(pieces, *args, **kwargs))
+    store.ingest(extract(tmp_path / "delta.csv", [(5, 2011, 2, 'RESOL'), (100, 2013, 0, 'OPEN')]), store_path)
+    read_again = [piece for piece in merges[0] if isinstance(piece, str)]
+    assert sorted(read_again) == [store.partition_path(2011, 2, store_path), store.partition_path(2013, 0, store_path)]
+    # the same rows as merging every partition from scratch, by neighborhood then year
+    parts = sorted(store.partitions(store_path).items(), key=lambda item: (item[0][1], item[0][0]))
+    full = concat([read_snapshot(path) for _, path in parts])
+    assert merged(store_path).equals(full)
+
+
+def test_query_only_reads_the_pruned_partitions_and_columns(tmp_path, monkeypatch):
+    store_path = str(tmp_path / "store")
+    store.ingest(extract(tmp_path / "first.csv", [(case, 2010 + case % 4, case % 3, 'OPEN')
+                                                  for case in range(1, 40)]), store_path)
+    reads = []
+    monkeypatch.setattr(store, "read_snapshot",
+                        lambda path, usecols=None: reads.append((path, usecols)) or read_snapshot(path, usecols))
+    calls = store.query([0, 2], [2011, 2012], columns=['CASE ID', 'nbh_id'], store_path=store_path)
+    assert sorted(path for path, _ in reads) == sorted(store.partition_path(year, nbhid, store_path)
+                                                       for year in (2011, 2012) for nbhid in (0, 2))
+    assert all(usecols == ['CASE ID', 'nbh_id'] for _, usecols in reads)
+    assert list(calls.columns) == ['CASE ID', 'nbh_id']
+    assert sorted(calls['CASE ID']) == [case for case in range(1, 40) if case % 3 in (0, 2) and case % 4 in (1, 2)]
+    # by neighborhood, then year
+    assert calls['nbh_id'].is_monotonic_increasing
+    assert store.query([0], [2011, 2011], [4, 12], ['CASE ID'], store_path).empty
+    assert len(store.query([0], [2011, 2011], [3, 3], ['CASE ID'], store_path)) == 3
+    assert list(store.query([7], columns=['CASE ID', 'STATUS'], store_path=store_path).columns) == ['CASE ID', 'STATUS']
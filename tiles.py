@@ -0,0 +1,146 @@
+"""
+Web map tiles of the 311 calls.
+
+The map of app.py loads the z/x/y tiles in view from its /tiles route, so
+a payload is bounded by what a tile covers rather than by the selection.
+
+``build`` keeps the located calls sorted along a Z-order (Morton) curve of
+their tile at TILE_ZOOM. The calls of any tile up to that zoom are then one
+run of the store, found with two binary searches, and the ones of a deeper
+tile are filtered out of the run of its ancestor at TILE_ZOOM.
+``tiles_in_bounds`` lists the tiles that cover a map viewport, and
+``points_in_bounds`` finds the calls of any bbox with the same searches, over
+the few runs of the tiles that cover it.
+"""
+import numpy as np
+
+# zoom of the Morton keys of the store, tiles of about 600 m at Kansas City
+TILE_ZOOM = 16
+MIN_ZOOM = 9
+MAX_ZOOM = 18
+# web mercator stops at this latitude
+MAX_LATITUDE = 85.0511287798
+# most tiles (runs of the store) searched for the calls of a bbox
+MAX_RANGES = 256
+
+COLUMNS = ['LATITUDE', 'LONGITUDE', 'NEIGHBORHOOD', 'DAYS TO CLOSE', 'nbhid', 'CREATION YEAR']
+
+
+def tile_xy(lat, lon, zoom):
+    """ The x and y of the tiles of ``zoom`` holding the points ``lat``, ``lon`` """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    lon = np.asarray(lon, dtype=float)
+    n = 2 ** zoom
+    x = (lon + 180) / 360 * n
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n
+    return (np.clip(np.floor(x), 0, n - 1).astype(np.int64),
+            np.clip(np.floor(y), 0, n - 1).astype(np.int64))
+
+
+def tile_bounds(z, x, y):
+    """ [[south, west], [north, east]] of tile z/x/y """
+    n = 2 ** z
+
+    def latitude(tile_y):
+        return float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * tile_y / n)))))
+
+    return [[latitude(y + 1), x / n * 360 - 180], [latitude(y), (x + 1) / n * 360 - 180]]
+
+
+def _spread(values):
+    """ The bits of ``values`` (up to 32) moved to the even bit positions """
+    values = np.asarray(values, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def morton(x, y):
+    """ Z-order keys of the tiles ``x``, ``y``: the tiles of a parent tile are one run of keys """
+    return _spread(x) | (_spread(y) << np.uint64(1))
+
+
+def build(frame):
+    """ The located calls of ``frame``, sorted by the Morton key of their tile at TILE_ZOOM """
+    lat = frame['LATITUDE'].to_numpy(dtype=float)
+    lon = frame['LONGITUDE'].to_numpy(dtype=float)
+    located = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+    keys = morton(*tile_xy(lat[located], lon[located], TILE_ZOOM))
+    order = np.argsort(keys, kind='stable')
+    points = frame[[col for col in COLUMNS if col in frame.columns]].take(located[order])
+    extent = None
+    if len(located):
+        extent = [[float(lat[located].min()), float(lon[located].min())],
+                  [float(lat[located].max()), float(lon[located].max())]]
+    return {'keys': keys[order], 'points': points.reset_index(drop=True), 'extent': extent}
+
+
+def tile_points(store, z, x, y):
+    """ The calls of ``store`` within tile z/x/y """
+    depth = max(TILE_ZOOM - z, 0)
+    top = (np.array([x]) >> max(z - TILE_ZOOM, 0), np.array([y]) >> max(z - TILE_ZOOM, 0))
+    first = morton(*top)[0] << np.uint64(2 * depth)
+    last = first + (np.uint64(1) << np.uint64(2 * depth))
+    start, end = np.searchsorted(store['keys'], [first, last])
+    points = store['points'].iloc[start:end]
+    if z > TILE_ZOOM:
+        xs, ys = tile_xy(points['LATITUDE'].to_numpy(), points['LONGITUDE'].to_numpy(), z)
+        points = points[(xs == x) & (ys == y)]
+    return points
+
+
+def tiles_in_bounds(bounds, zoom, extent=None):
+    """
+    The (z, x, y) of the tiles covering ``bounds``, [[south, west], [north,
+    east]] as dl.Map reports them, one zoom level below the map's ``zoom``
+    (tiles of 512 pixels, a dozen per screen) and within MIN_ZOOM and
+    MAX_ZOOM. Only the part of ``bounds`` within ``extent`` (the one of a
+    store) is covered when it is given.
+    """
+    z = int(min(max(int(zoom) - 1, MIN_ZOOM), MAX_ZOOM))
+    (south, west), (north, east) = bounds
+    if extent is not None:
+        (south, west), (north, east) = ([max(south, extent[0][0]), max(west, extent[0][1])],
+                                        [min(north, extent[1][0]), min(east, extent[1][1])])
+        if south > north or west > east:
+            return []
+    (x0, x1), (y1, y0) = tile_xy([south, north], [west, east], z)
+    return [(z, int(x), int(y)) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def cover_bounds(bounds, zoom, extent=None):
+    """
+    [[south, west], [north, east]] of the tiles ``tiles_in_bounds`` lists
+    for ``bounds`` and the map's ``zoom``, within ``extent`` when it is
+    given: the viewport with a margin of up to a tile, the same for every
+    small pan within it. ``bounds`` as they are when no tile is left.
+    """
+    covering = tiles_in_bounds(bounds, zoom, extent)
+    if not covering:
+        return bounds
+    z, x0, y0 = min(covering)
+    _, x1, y1 = max(covering)
+    return [tile_bounds(z, x0, y1)[0], tile_bounds(z, x1, y0)[1]]
+
+
+def points_in_bounds(store, bounds):
+    """ The calls of ``store`` within ``bounds``, [[south, west], [north, east]] """
+    (south, west), (north, east) = bounds
+    # the deepest tiles of at most MAX_RANGES that cover bounds
+    for z in range(TILE_ZOOM, -1, -1):
+        (x0, x1), (y1, y0) = tile_xy([south, north], [west, east], z)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= MAX_RANGES:
+            break
+    xs, ys = np.meshgrid(np.arange(x0, x1 + 1), np.arange(y0, y1 + 1))
+    depth = np.uint64(2 * (TILE_ZOOM - z))
+    firsts = np.sort(morton(xs.ravel(), ys.ravel())) << depth
+    lasts = firsts + (np.uint64(1) << depth)
+    # tiles next to each other along the curve are one run
+    breaks = firsts[1:] != lasts[:-1]
+    starts = np.searchsorted(store['keys'], firsts[np.concatenate([[True], breaks])])
+    ends = np.searchsorted(store['keys'], lasts[np.concatenate([breaks, [True]])])
+    rows = np.concatenate([np.arange(0)] + [np.arange(start, end) for start, end in zip(starts, ends)])
+    points = store['points'].take(rows)
+    lat, lon = points['LATITUDE'].to_numpy(), points['LONGITUDE'].to_numpy()
+    return points[(lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)]
@@ -0,0 +1,81 @@
+"""
+Structured traces of the data layer queries.
+
+Every selection, aggregate and geojson build of dataset.py records what it
+did: its parameters, the path it took (row index, selection cache, raw
+scan, cube or SQL engine), the number of rows it returned and the wall time
+of each of its stages. The last ``KC311_TRACE_SIZE`` traces (200 by
+default) are served as JSON by app.py under /debug/traces when
+KC311_DEBUG=1 (?op=select and ?slow=1 narrow them down), and the traces
+slower than ``KC311_TRACE_BUDGET_MS`` (100 by default, 0 logs all of them)
+are also printed as one line each, to find the neighborhoods and ranges
+that blow the latency budget.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+
+import numpy as np
+
+TRACE_SIZE = int(os.environ.get("KC311_TRACE_SIZE", "200"))
+BUDGET_MS = float(os.environ.get("KC311_TRACE_BUDGET_MS", "100"))
+
+_traces = collections.deque(maxlen=TRACE_SIZE)
+_lock = threading.Lock()
+
+
+def _plain(value):
+    """ ``value`` with numpy scalars and tuples turned into what JSON takes """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_plain(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _plain(item) for key, item in value.items()}
+    return value
+
+
+def _log_line(record):
+    params = " ".join("%s=%s" % (key, value) for key, value in record['params'].items() if value is not None)
+    details = " ".join("%s=%s" % (key, record[key]) for key in ('path', 'cache', 'rows') if key in record)
+    stages = ", ".join("%s %.1f" % (stage, ms) for stage, ms in record['stages'].items())
+    return "trace %s %s %s %.1fms%s" % (record['op'], details, params, record['ms'],
+                                       " (%s)" % stages if stages else "")
+
+
+@contextlib.contextmanager
+def span(op, **params):
+    """
+    Trace the ``op`` query run in the with block, which can add to the
+    yielded record (path, cache, rows, ...) and time its ``stage``s
+    """
+    record = {'op': op, 'params': _plain(params), 'stages': {}, 'time': time.time()}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['ms'] = round((time.perf_counter() - start) * 1000, 3)
+        with _lock:
+            _traces.append(record)
+        if record['ms'] >= BUDGET_MS:
+            print(_log_line(record))
+
+
+@contextlib.contextmanager
+def stage(record, name):
+    """ Time the ``name`` stage of a traced query """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record['stages'][name] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def recent(op=None, slow=False):
+    """ The recorded traces, newest first, only those of ``op`` or over budget if asked """
+    with _lock:
+        traces = list(_traces)
+    return [record for record in reversed(traces)
+            if (op is None or record['op'] == op) and (not slow or record['ms'] >= BUDGET_MS)]